@@ -0,0 +1,186 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Circuit breakers for the upstream API hosts. A host that keeps failing
+    is opened so calls to it fail fast, and after BREAKER_RESET_TIMEOUT
+    seconds a single probe call is let through to see if it recovered.
+    When a collection is given the open and closed transitions are shared
+    with other workers through one state document per host.
+"""
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import PyMongoError
+from cap import client
+
+
+import cap.config.celery as config
+import threading
+import time
+import os
+
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+HOST_FAILURE_STATUSES = (500, 502, 503, 504)
+HOST_FAILURE_KINDS = ('timeout', 'connection')
+
+logger = get_task_logger(__name__)
+_breakers, _breakers_pid = {}, None
+_breakers_lock = threading.Lock()
+
+
+def threshold():
+    return int(getattr(config, 'BREAKER_FAILURE_THRESHOLD', 5))
+
+
+def reset_timeout():
+    return float(getattr(config, 'BREAKER_RESET_TIMEOUT', 30))
+
+
+def sync_interval():
+    return float(getattr(config, 'BREAKER_SYNC_INTERVAL', 5))
+
+
+def host_failed(response):
+    # Rate limiting and bad requests say nothing about the host's health
+    if isinstance(response, client.RequestFailure):
+        return response.kind in HOST_FAILURE_KINDS
+
+    return response.status_code in HOST_FAILURE_STATUSES
+
+
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.changed_at = 0
+        self.synced_at = 0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self, collection=None):
+        if collection is not None:
+            self.sync(collection)
+
+        with self._lock:
+            now = time.time()
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN and now - self.opened_at >= reset_timeout():
+                self.state, self.probing = HALF_OPEN, False
+
+            # Only one probe at a time is let through a half open breaker
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+
+            return False
+
+    def record(self, healthy, collection=None):
+        with self._lock:
+            self.probing = False
+            if healthy:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.transition(CLOSED, collection)
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= threshold():
+                    if self.state != OPEN:
+                        self.transition(OPEN, collection)
+
+    def transition(self, state, collection=None):
+        now = time.time()
+        self.state, self.changed_at = state, now
+        if state == OPEN:
+            self.opened_at = now
+        else:
+            self.failures = 0
+
+        if collection is None:
+            return
+
+        # Transitions are rare, so the write stays under the lock to keep
+        # them in order. The local state stands when Mongo is unavailable.
+        try:
+            collection.update(
+                {
+                    '_id': self.host
+                }, {
+                    '$set': {
+                        'state': state,
+                        'opened_at': self.opened_at,
+                        'changed_at': now
+                    }
+                },
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(
+                'Unable to share the breaker for %s: %s' % (self.host, e)
+            )
+
+    def sync(self, collection):
+        # Only one caller per interval reads, and it does so outside the
+        # lock so a slow Mongo does not hold up the other callers
+        with self._lock:
+            now = time.time()
+            if now - self.synced_at < sync_interval():
+                return
+
+            self.synced_at = now
+
+        try:
+            shared = collection.find_one({'_id': self.host})
+        except PyMongoError as e:
+            logger.error(
+                'Unable to read the breaker for %s: %s' % (self.host, e)
+            )
+            return
+
+        # The most recent transition made by any worker wins
+        with self._lock:
+            if not shared or shared.get('changed_at', 0) <= self.changed_at:
+                return
+
+            self.state = shared.get('state', CLOSED)
+            self.opened_at = shared.get('opened_at', 0)
+            self.changed_at = shared.get('changed_at')
+            self.probing = False
+            if self.state == CLOSED:
+                self.failures = 0
+
+
+def get_breaker(url):
+    global _breakers, _breakers_pid
+    host = client.upstream_host(url)
+    with _breakers_lock:
+        if _breakers_pid != os.getpid():
+            _breakers, _breakers_pid = {}, os.getpid()
+
+        circuit = _breakers.get(host)
+        if circuit is None:
+            circuit = CircuitBreaker(host)
+            _breakers[host] = circuit
+
+    return circuit
+
+
+def clear():
+    global _breakers
+    with _breakers_lock:
+        _breakers = {}
@@ -0,0 +1,455 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate
+
+
+import cap.config.celery as config
+import multiprocessing
+import threading
+import requests
+import calendar
+import random
+import time
+import os
+
+
+# Needed for Python 2 & 3
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+_sessions, _sessions_pid = {}, None
+_sessions_lock = threading.Lock()
+_pools, _pools_pid = {}, None
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+# Calls made from inside a pool thread use the next level's pool, so a
+# waiting parent can never starve the threads its children need
+MAX_POOL_DEPTH = 2
+
+RETRY_STATUSES = (413, 429, 502, 503, 504)
+RETRY_AFTER_STATUSES = (413, 429, 503)
+RETRY_FAILURES = ('timeout', 'connection')
+# Path segments following these hold credentials and are never logged
+SECRET_SEGMENTS = ('tokens',)
+
+
+def pool_size():
+    size = getattr(config, 'HTTP_POOL_SIZE', None)
+    if size:
+        return int(size)
+
+    size = getattr(config, 'CELERYD_CONCURRENCY', None)
+    if not size:
+        try:
+            size = multiprocessing.cpu_count()
+        except NotImplementedError:
+            size = 1
+
+    # Every thread that can call a host at once keeps its socket alive,
+    # the adaptive limiter lets up to LIMITER_MAX of them through
+    return max(
+        int(size),
+        pool_threads(0) + pool_threads(1),
+        int(getattr(config, 'LIMITER_MAX', 32))
+    )
+
+
+def upstream_host(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc.lower())
+
+
+def loggable_url(url):
+    # Host and path only, query strings and credentials are left out
+    if not url:
+        return url
+
+    segments = urlparse(url).path.split('/')
+    for index in range(1, len(segments)):
+        if segments[index - 1] in SECRET_SEGMENTS and segments[index]:
+            segments[index] = '<redacted>'
+
+    return '%s%s' % (upstream_host(url), '/'.join(segments))
+
+
+def get_session(url):
+    global _sessions, _sessions_pid
+    host = upstream_host(url)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Pooled sockets can not be shared with a forked parent process
+            _sessions, _sessions_pid = {}, os.getpid()
+
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.mount(
+                host,
+                HTTPAdapter(pool_connections=1, pool_maxsize=pool_size())
+            )
+            _sessions[host] = session
+
+    return session
+
+
+def close_sessions():
+    global _sessions
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+
+        _sessions = {}
+
+
+def set_deadline(deadline):
+    # Epoch seconds the current query has to finish by, or None
+    _local.deadline = deadline
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+def set_account(account):
+    # Account the current task's calls are made for, used to key limits
+    _local.account = account
+
+
+def current_account():
+    return getattr(_local, 'account', None)
+
+
+def remaining():
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+
+    return max(0.0, deadline - time.time())
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def timeouts():
+    connect = float(getattr(config, 'CONNECT_TIMEOUT', 5))
+    read = float(getattr(config, 'READ_TIMEOUT', 30))
+    left = remaining()
+    if left is not None:
+        # Calls never wait past what is left of the query's deadline
+        left = max(left, 0.001)
+        connect, read = min(connect, left), min(read, left)
+
+    return (connect, read)
+
+
+class RequestFailure:
+    """
+        Returned in place of content when an upstream call fails. It is
+        false like the None it replaces, and kind classifies the failure.
+    """
+    def __init__(self, kind, url, status=None, message=None):
+        self.kind = kind
+        self.url = url
+        self.status = status
+        self.message = message
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'RequestFailure(%s, %s, %s)' % (
+            self.kind,
+            self.status,
+            loggable_url(self.url)
+        )
+
+    def to_dict(self):
+        return {'kind': self.kind, 'status': self.status, 'url': self.url}
+
+
+def classify_response(url, response):
+    status = response.status_code
+    if status in (401, 403):
+        kind = 'unauthorized'
+    elif status == 404:
+        kind = 'not_found'
+    elif status in (413, 429):
+        kind = 'rate_limited'
+    elif status in (502, 503, 504):
+        kind = 'unavailable'
+    elif status >= 500:
+        kind = 'server_error'
+    else:
+        kind = 'client_error'
+
+    return RequestFailure(kind, url, status)
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = parsedate(value)
+        if parsed is None:
+            return None
+
+        return max(0.0, calendar.timegm(parsed) - time.time())
+
+
+def backoff_delay(attempt):
+    # Full jitter so retries from many workers do not arrive together
+    ceiling = min(
+        float(getattr(config, 'RETRY_MAX_DELAY', 30)),
+        float(getattr(config, 'RETRY_BACKOFF', 0.5)) * 2 ** attempt
+    )
+    return random.uniform(0, ceiling)
+
+
+def retry_delay(attempt, response):
+    """
+        Seconds to wait before retrying the call that gave response, or
+        None when it should not be retried. A Retry-After longer than
+        RETRY_MAX_DELAY, or a wait that would pass the query's deadline,
+        is not waited out.
+    """
+    if attempt >= int(getattr(config, 'UPSTREAM_RETRIES', 3)):
+        return None
+
+    delay = wanted_delay(attempt, response)
+    left = remaining()
+    if delay is not None and left is not None and delay >= left:
+        return None
+
+    return delay
+
+
+def wanted_delay(attempt, response):
+    if isinstance(response, RequestFailure):
+        if response.kind in RETRY_FAILURES:
+            return backoff_delay(attempt)
+
+        return None
+
+    if response.status_code not in RETRY_STATUSES:
+        return None
+
+    if response.status_code in RETRY_AFTER_STATUSES:
+        delay = retry_after(response)
+        if delay is not None:
+            if delay > float(getattr(config, 'RETRY_MAX_DELAY', 30)):
+                return None
+
+            return delay
+
+    return backoff_delay(attempt)
+
+
+def concurrency():
+    return int(getattr(config, 'UPSTREAM_CONCURRENCY', 4))
+
+
+def page_window():
+    return int(getattr(config, 'PAGINATION_WINDOW', None) or concurrency())
+
+
+def pool_threads(depth):
+    # Pages are fetched a level down, where a listing may fan out wider
+    # than a task's own calls and the adaptive limiter keeps it in check
+    if depth > 0:
+        return max(concurrency(), page_window())
+
+    return concurrency()
+
+
+def get_thread_pool(depth):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools, _pools_pid = {}, os.getpid()
+
+        pool = _pools.get(depth)
+        if pool is None:
+            pool = ThreadPool(pool_threads(depth))
+            _pools[depth] = pool
+
+    return pool
+
+
+def _call_at_depth(depth, deadline, account, function, args):
+    _local.depth = depth
+    _local.deadline = deadline
+    _local.account = account
+    return function(*args)
+
+
+class Deferred:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def get(self):
+        return self.function(*self.args)
+
+
+def submit(function, *args):
+    """
+        Start function in the background and return an object whose get()
+        waits for the result. Runs lazily in the caller when concurrent
+        upstream calls are disabled or the pool depth has been exhausted.
+    """
+    depth = getattr(_local, 'depth', 0)
+    if (
+        depth >= MAX_POOL_DEPTH or
+        not getattr(config, 'CONCURRENT_UPSTREAM_CALLS', True)
+    ):
+        return Deferred(function, args)
+
+    # The caller's deadline and account follow the call into the pool thread
+    return get_thread_pool(depth).apply_async(
+        _call_at_depth,
+        (depth + 1, current_deadline(), current_account(), function, args)
+    )
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+        Callers passing the same key while a call is in flight wait for it
+        and share its result instead of making the call again.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            # A follower gives up when its own deadline passes first
+            if not flight.done.wait(remaining()):
+                return RequestFailure('deadline', None)
+
+            return flight.result
+
+        try:
+            flight.result = function(*args)
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+        return flight.result
+
+
+class Race:
+    """
+        Calls started on a race run in their own threads, carrying the
+        caller's deadline and account. The first response wins, or the
+        last failure when every call fails.
+    """
+    def __init__(self):
+        self.results = []
+        self.running = 0
+        self._finished = threading.Condition()
+
+    def start(self, function, *args):
+        with self._finished:
+            self.running += 1
+
+        thread = threading.Thread(
+            target=self._run,
+            args=(
+                getattr(_local, 'depth', 0),
+                current_deadline(),
+                current_account(),
+                function,
+                args
+            )
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, depth, deadline, account, function, args):
+        result = RequestFailure('error', None)
+        try:
+            result = _call_at_depth(depth, deadline, account, function, args)
+        finally:
+            with self._finished:
+                self.running -= 1
+                self.results.append(result)
+                self._finished.notify_all()
+
+    def settled(self):
+        if any(not isinstance(r, RequestFailure) for r in self.results):
+            return True
+
+        return bool(self.results) and self.running == 0
+
+    def wait(self, timeout=None):
+        give_up = None if timeout is None else time.time() + timeout
+        with self._finished:
+            while not self.settled():
+                wait = None if give_up is None else give_up - time.time()
+                if wait is not None and wait <= 0:
+                    return False
+
+                self._finished.wait(wait)
+
+            return True
+
+    def winner(self):
+        with self._finished:
+            for result in self.results:
+                if not isinstance(result, RequestFailure):
+                    return result
+
+            return self.results[-1]
+
+
+def run_concurrently(*calls):
+    """
+        Run each (function, args) pair and return the results in order.
+    """
+    if len(calls) < 2:
+        return [function(*args) for function, args in calls]
+
+    pending = [submit(function, *args) for function, args in calls]
+    return [result.get() for result in pending]
@@ -35,6 +35,7 @@ CELERY_DISABLE_RATE_LIMITS = True
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+CELERY_TRACK_STARTED = True
 
 try:
     MONGO_HOST = os.environ['CAP_DB_1_PORT_27017_TCP_ADDR']
@@ -46,3 +47,104 @@ MONGO_USER = None
 MONGO_PASS = None
 MONGO_DATABASE = 'cap'
 MONGO_KWARGS = {'tz_aware': True}
+
+# Size of the keep-alive connection pool kept per upstream host in each
+# worker process. Defaults to enough sockets for every thread that can call
+# a host at once, the upstream and page pools or LIMITER_MAX, and never
+# less than CELERYD_CONCURRENCY or the CPU count.
+HTTP_POOL_SIZE = None
+
+# Run the independent upstream calls of a product task at the same time
+# using a bounded pool of UPSTREAM_CONCURRENCY threads per worker process.
+CONCURRENT_UPSTREAM_CALLS = True
+UPSTREAM_CONCURRENCY = 4
+
+# Flavor definitions are cached per region for FLAVOR_CACHE_TTL seconds.
+# Set FLAVOR_CACHE_COLLECTION to a collection name to keep the catalog in
+# Mongo so it survives worker restarts.
+FLAVOR_CACHE_TTL = 3600
+FLAVOR_CACHE_COLLECTION = None
+
+# Most offset pages requested ahead while paginating, and the number of
+# threads page fetches run on. Defaults to UPSTREAM_CONCURRENCY.
+PAGINATION_WINDOW = 16
+
+# Seconds between checks of the limit map version in settings. Compiled
+# limit plans are rebuilt when the version has changed.
+LIMIT_PLAN_CHECK_INTERVAL = 30
+
+# Validated tokens are cached for TOKEN_CACHE_TTL seconds, never past the
+# token's own expiry. Set TOKEN_CACHE_COLLECTION to share the validations
+# across web and worker processes through Mongo.
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_COLLECTION = 'token_cache'
+
+# Concurrent GETs for the same URL and token in a worker share a single
+# upstream call when enabled.
+COALESCE_UPSTREAM_CALLS = True
+
+# Seconds the broker queue depth is cached for when suggesting poll
+# intervals to the query page.
+QUEUE_DEPTH_TTL = 5
+
+# Query results are cached per account, region and product. Results
+# younger than RESULT_CACHE_FRESH seconds are answered from the cache.
+# Older ones are shown right away while a refresh runs in the background,
+# until Mongo removes them after RESULT_CACHE_TTL seconds. Set the
+# collection to None to always query the APIs.
+RESULT_CACHE_COLLECTION = 'result_cache'
+RESULT_CACHE_FRESH = 300
+RESULT_CACHE_TTL = 3600
+
+# Upstream calls give up connecting after CONNECT_TIMEOUT seconds and
+# waiting for data after READ_TIMEOUT seconds. Timeouts, dropped
+# connections and 413/429/502/503/504 responses are retried up to
+# UPSTREAM_RETRIES times with jittered exponential backoff starting at
+# RETRY_BACKOFF seconds. A Retry-After header is honored when it is no
+# longer than RETRY_MAX_DELAY seconds.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+UPSTREAM_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_DELAY = 30
+
+# A host is marked degraded after BREAKER_FAILURE_THRESHOLD timeouts,
+# dropped connections or 5xx responses in a row. Calls to it then fail
+# fast, and a probe is let through every BREAKER_RESET_TIMEOUT seconds.
+# Set BREAKER_COLLECTION to share the state across workers through Mongo,
+# which is read at most every BREAKER_SYNC_INTERVAL seconds.
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_COLLECTION = 'circuit_breakers'
+BREAKER_SYNC_INTERVAL = 5
+
+# Each account gets an adaptive limit on calls in flight to a host. It
+# starts at LIMITER_INITIAL and grows by about one for every round of calls
+# answered within LIMITER_LATENCY_TARGET seconds, up to LIMITER_MAX. Each
+# rate limit response multiplies it by LIMITER_DECREASE, never going under
+# LIMITER_MIN. Set LIMITER_COLLECTION to have workers pass rate limits on
+# to each other through a counter document. Other workers read it at most
+# every LIMITER_SYNC_INTERVAL seconds, and it expires LIMITER_STATE_TTL
+# seconds after the last rate limit.
+LIMITER_INITIAL = 4
+LIMITER_MIN = 1
+LIMITER_MAX = 32
+LIMITER_DECREASE = 0.5
+LIMITER_LATENCY_TARGET = 2
+LIMITER_COLLECTION = 'rate_limits'
+LIMITER_SYNC_INTERVAL = 5
+LIMITER_STATE_TTL = 3600
+
+# Set HEDGE_REQUESTS to True to send a GET a second time when it has not
+# been answered by the HEDGE_PERCENTILE latency of the last
+# HEDGE_SAMPLE_SIZE calls to its endpoint, whichever answers first wins.
+# Endpoints with fewer than HEDGE_MIN_SAMPLES calls are never hedged, and
+# hedges are kept under HEDGE_MAX_RATE of all calls so they cannot add much
+# load to an API that is already slow. Latencies are kept for at most
+# HEDGE_MAX_ENDPOINTS endpoints, shared by every account.
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+HEDGE_SAMPLE_SIZE = 100
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_RATE = 0.05
+HEDGE_MAX_ENDPOINTS = 500
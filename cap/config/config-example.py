@@ -35,3 +35,28 @@ ADMIN_NAME = 'Admin Full Name'
 ADMIN_EMAIL = 'Admin email'
 
 SECRET_KEY = 'base-app-secret'
+
+# Query results are pushed to the page with Server-Sent Events. The stream
+# checks the tasks every STREAM_POLL_INTERVAL seconds and closes after
+# STREAM_TIMEOUT seconds. Open streams need an async worker such as
+# gunicorn -k gevent so they do not hold a sync worker each.
+STREAM_POLL_INTERVAL = 0.5
+STREAM_TIMEOUT = 300
+
+# Bounds in milliseconds for the poll interval suggested to the query page
+# through the X-Poll-Interval header. Queued tasks are polled less often
+# the deeper the task queue is.
+POLL_INTERVAL_MIN = 1000
+POLL_INTERVAL_MAX = 10000
+
+# Batch queries posted to /query/batch keep at most BATCH_CONCURRENCY
+# accounts in the task pipeline at once and stream a line of JSON per
+# account as it finishes. The stream gives up on unfinished accounts
+# after BATCH_TIMEOUT seconds.
+BATCH_CONCURRENCY = 10
+BATCH_MAX_ACCOUNTS = 500
+BATCH_TIMEOUT = 1800
+
+# Seconds a query has to finish. Upstream calls are cut short when the
+# deadline passes and the products are shown with partial results.
+QUERY_DEADLINE = 60
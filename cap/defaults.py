@@ -88,6 +88,10 @@ def application_initialize(db, app):
                                 '/',
                                 '/query/',
                                 '/query/status/<task_id>',
+                                '/query/results/<query_id>',
+                                '/query/stream/<query_id>',
+                                '/query/batch',
+                                '/query/compare/<query_id>',
                                 '/admin/logout/',
                             ]
                         }, {
@@ -0,0 +1,173 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Recent latencies per endpoint and the budget for hedged GETs. A GET
+    that has not been answered by the HEDGE_PERCENTILE latency of its
+    endpoint is sent a second time, as long as hedges stay under
+    HEDGE_MAX_RATE of all the calls made.
+"""
+
+from collections import OrderedDict, deque
+from cap import client
+
+
+import cap.config.celery as config
+import threading
+import math
+import os
+
+
+# Counts are halved past this many calls so the rate follows recent load
+BUDGET_WINDOW = 1000
+
+_windows, _budget, _hedging_pid = OrderedDict(), None, None
+_hedging_lock = threading.Lock()
+
+
+def enabled():
+    return bool(getattr(config, 'HEDGE_REQUESTS', False))
+
+
+def percentile():
+    return float(getattr(config, 'HEDGE_PERCENTILE', 95))
+
+
+def min_samples():
+    return int(getattr(config, 'HEDGE_MIN_SAMPLES', 20))
+
+
+def sample_size():
+    return int(getattr(config, 'HEDGE_SAMPLE_SIZE', 100))
+
+
+def max_rate():
+    return float(getattr(config, 'HEDGE_MAX_RATE', 0.05))
+
+
+def max_endpoints():
+    return int(getattr(config, 'HEDGE_MAX_ENDPOINTS', 500))
+
+
+def endpoint(url, account=None):
+    """
+        Host and URI template of a call, so every account and every page
+        of a listing feed the same latency window.
+    """
+    path = url.split('?', 1)[0]
+    if not account:
+        return path
+
+    host = client.upstream_host(path)
+    segments = [
+        '{ddi}' if segment == str(account) else segment
+        for segment in path[len(host):].split('/')
+    ]
+    return host + '/'.join(segments)
+
+
+class LatencyWindow:
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self.samples)
+
+        if not samples or len(samples) < min_samples():
+            return None
+
+        index = int(math.ceil(pct / 100.0 * len(samples))) - 1
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+
+class HedgeBudget:
+    def __init__(self):
+        self.calls = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+            if self.calls > BUDGET_WINDOW:
+                self.calls, self.hedges = self.calls // 2, self.hedges // 2
+
+    def take(self, rate):
+        with self._lock:
+            if self.hedges + 1 > rate * self.calls:
+                return False
+
+            self.hedges += 1
+            return True
+
+
+def _state():
+    global _windows, _budget, _hedging_pid
+    with _hedging_lock:
+        if _hedging_pid != os.getpid() or _budget is None:
+            _windows, _budget = OrderedDict(), HedgeBudget()
+            _hedging_pid = os.getpid()
+
+        return _windows, _budget
+
+
+def get_window(url):
+    windows, budget = _state()
+    key = endpoint(url, client.current_account())
+    with _hedging_lock:
+        # Least recently used endpoints are dropped past the limit
+        window = windows.pop(key, None)
+        if window is None:
+            window = LatencyWindow(sample_size())
+
+        windows[key] = window
+        while len(windows) > max_endpoints():
+            windows.popitem(last=False)
+
+    return window
+
+
+def record_latency(url, seconds):
+    get_window(url).add(seconds)
+
+
+def hedge_delay(url):
+    """
+        Seconds to wait on a call before hedging it, or None when the
+        endpoint has too few samples or the deadline comes first.
+    """
+    _state()[1].record_call()
+    delay = get_window(url).percentile(percentile())
+    left = client.remaining()
+    if delay is None or (left is not None and delay >= left):
+        return None
+
+    return delay
+
+
+def take_hedge():
+    return _state()[1].take(max_rate())
+
+
+def clear():
+    global _budget
+    with _hedging_lock:
+        _windows.clear()
+        _budget = None
@@ -36,12 +36,12 @@ def normalize(string):
         return re.sub('\s+', ' ', string.strip())
 
 
-def log_entry(data):
+def log_entry(data, tasks=None, regions=None):
     # Removing data elements we do not need
     ddi = data.pop('ddi')
     region = data.pop('region')
-    del data['csrf_token']
-    del data['token']
+    data.pop('csrf_token', None)
+    data.pop('token', None)
 
     products_queried = []
     for product, value in iteritems(data):
@@ -54,7 +54,11 @@ def log_entry(data):
         'queried': products_queried,
         'query_results': [],
         'queried_at': datetime.datetime.now(UTC),
-        'queried_by': session.get('username')
+        'queried_by': session.get('username'),
+        'tasks': tasks or {}
     }
+    if regions:
+        store_data['regions'] = regions
+
     log_id = g.db.query_logs.insert(store_data)
     return log_id
@@ -0,0 +1,216 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Adaptive concurrency limits for each upstream host and account. The
+    number of calls allowed in flight grows by about one per round of
+    calls answered within LIMITER_LATENCY_TARGET seconds, and is cut by
+    LIMITER_DECREASE every time the API answers with a rate limit. When a
+    collection is given every cut also bumps a counter in a document
+    shared by all workers, and the others cut their own limit when they
+    see it move.
+"""
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import PyMongoError
+from cap import client
+
+
+import cap.config.celery as config
+import threading
+import datetime
+import time
+import os
+
+
+RATE_LIMITED_STATUSES = (413, 429)
+
+logger = get_task_logger(__name__)
+_limiters, _limiters_pid = {}, None
+_limiters_lock = threading.Lock()
+
+
+def initial_limit():
+    return float(getattr(config, 'LIMITER_INITIAL', 4))
+
+
+def min_limit():
+    return float(getattr(config, 'LIMITER_MIN', 1))
+
+
+def max_limit():
+    return float(getattr(config, 'LIMITER_MAX', 32))
+
+
+def decrease_factor():
+    return float(getattr(config, 'LIMITER_DECREASE', 0.5))
+
+
+def latency_target():
+    return float(getattr(config, 'LIMITER_LATENCY_TARGET', 2))
+
+
+def sync_interval():
+    return float(getattr(config, 'LIMITER_SYNC_INTERVAL', 5))
+
+
+def state_ttl():
+    return float(getattr(config, 'LIMITER_STATE_TTL', 3600))
+
+
+def rate_limited(response):
+    if isinstance(response, client.RequestFailure):
+        return response.kind == 'rate_limited'
+
+    return response.status_code in RATE_LIMITED_STATUSES
+
+
+def healthy(response):
+    if isinstance(response, client.RequestFailure):
+        return False
+
+    return bool(response.ok)
+
+
+class AdaptiveLimiter:
+    def __init__(self, key):
+        self.key = key
+        self.limit = max(min_limit(), min(initial_limit(), max_limit()))
+        self.in_flight = 0
+        self.decreased_at = 0
+        self.backoffs = None
+        self.synced_at = 0
+        self._ready = threading.Condition()
+
+    def acquire(self, timeout=None, collection=None):
+        """
+            Wait for a free slot and return the time it was taken, or None
+            when timeout seconds pass first.
+        """
+        give_up = None if timeout is None else time.time() + timeout
+        self.sync(collection)
+        with self._ready:
+            while self.in_flight >= int(self.limit):
+                wait = None if give_up is None else give_up - time.time()
+                if wait is not None and wait <= 0:
+                    return None
+
+                self._ready.wait(wait)
+
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, response, collection=None):
+        with self._ready:
+            self.in_flight -= 1
+            now = time.time()
+            if rate_limited(response):
+                # Calls sent before the last cut were part of the same burst
+                if started >= self.decreased_at:
+                    self.decrease(now)
+                    self.publish(collection, now)
+            elif healthy(response) and now - started <= latency_target():
+                self.limit = min(max_limit(), self.limit + 1.0 / self.limit)
+
+            self._ready.notify_all()
+
+    def decrease(self, now):
+        self.limit = max(min_limit(), self.limit * decrease_factor())
+        self.decreased_at = now
+
+    def publish(self, collection, now):
+        if collection is None:
+            return
+
+        # The local cut stands when Mongo is unavailable
+        try:
+            collection.update(
+                {
+                    '_id': self.key
+                }, {
+                    '$inc': {'backoffs': 1},
+                    '$set': {
+                        'expires': datetime.datetime.utcfromtimestamp(
+                            now + state_ttl()
+                        )
+                    }
+                },
+                upsert=True
+            )
+        except PyMongoError as e:
+            logger.error(
+                'Unable to share the limit for %s: %s' % (self.key, e)
+            )
+            return
+
+        self.backoffs = (self.backoffs or 0) + 1
+
+    def sync(self, collection):
+        # Only one caller per interval reads, and it does so outside the
+        # lock so a slow Mongo does not hold up releases
+        if collection is None:
+            return
+
+        with self._ready:
+            now = time.time()
+            if now - self.synced_at < sync_interval():
+                return
+
+            self.synced_at = now
+
+        try:
+            shared = collection.find_one({'_id': self.key}) or {}
+        except PyMongoError as e:
+            logger.error(
+                'Unable to read the limit for %s: %s' % (self.key, e)
+            )
+            return
+
+        backoffs = shared.get('backoffs', 0)
+        with self._ready:
+            # The first read only learns the counter, later moves mean
+            # another worker has been rate limited since
+            if self.backoffs is not None and backoffs > self.backoffs:
+                self.decrease(now)
+
+            self.backoffs = backoffs
+
+
+def limiter_key(url, account=None):
+    host = client.upstream_host(url)
+    if account:
+        return '%s|%s' % (host, account)
+
+    return host
+
+
+def get_limiter(url, account=None):
+    global _limiters, _limiters_pid
+    key = limiter_key(url, account)
+    with _limiters_lock:
+        if _limiters_pid != os.getpid():
+            _limiters, _limiters_pid = {}, os.getpid()
+
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveLimiter(key)
+            _limiters[key] = limiter
+
+    return limiter
+
+
+def clear():
+    global _limiters
+    with _limiters_lock:
+        _limiters = {}
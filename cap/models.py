@@ -20,64 +20,191 @@ from flask import g
 import re
 
 
-class Product:
-    def __init__(self, data):
-        self.id = data.get('_id')
-        self.title = normalize(data.get('title'))
-        self.db_name = data.get('db_name')
-        self.us_url = data.get('us_url')
-        self.uk_url = data.get('uk_url')
-        self.doc_url = data.get('doc_url')
-        self.pitchfork_url = data.get('pitchfork_url')
-        self.require_region = bool(data.get('require_region'))
-        self.active = bool(data.get('active'))
-        self.limit_maps = self.get_defined_limit_maps(data)
-
-    def set_db_name(self):
-        temp = re.sub(' +', ' ', str(self.title.lower().strip()))
-        self.db_name = re.sub(' ', '_', temp)
+class Model(object):
+    """
+        Immutable record with one slot per field. from_mongo builds it from
+        a Mongo document or submitted form and save_dict writes the fields
+        back out without the id, so instances can be shared between
+        requests, tasks and threads.
+    """
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **values):
+        for field in self.fields:
+            object.__setattr__(self, field, values.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((type(self), tuple(self.values().items())))
+
+    def __repr__(self):
+        return '%s(%s)' % (
+            type(self).__name__,
+            ', '.join(
+                '%s=%r' % (field, getattr(self, field))
+                for field in self.fields
+            )
+        )
+
+    def values(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def replace(self, **changes):
+        values = self.values()
+        values.update(changes)
+        return type(self)(**values)
 
     def save_dict(self):
-        temp = self.__dict__
-        del temp['id']
-        del temp['limit_maps']
+        temp = self.values()
+        temp.pop('id', None)
+        return temp
+
+    def to_mongo(self):
+        temp = self.save_dict()
+        if getattr(self, 'id', None):
+            temp['_id'] = self.id
+
         return temp
 
-    def get_defined_limit_maps(self, data):
-        temp = []
+
+class Product(Model):
+    fields = (
+        'id',
+        'title',
+        'db_name',
+        'us_url',
+        'uk_url',
+        'doc_url',
+        'pitchfork_url',
+        'require_region',
+        'active'
+    )
+    __slots__ = fields + ('_limit_maps',)
+
+    def __init__(self, **values):
+        super(Product, self).__init__(**values)
+        object.__setattr__(self, '_limit_maps', None)
+
+    @classmethod
+    def from_mongo(cls, data, limit_maps=None):
+        product = cls(
+            id=data.get('_id'),
+            title=normalize(data.get('title')),
+            db_name=data.get('db_name'),
+            us_url=data.get('us_url'),
+            uk_url=data.get('uk_url'),
+            doc_url=data.get('doc_url'),
+            pitchfork_url=data.get('pitchfork_url'),
+            require_region=bool(data.get('require_region')),
+            active=bool(data.get('active'))
+        )
+        if limit_maps is not None:
+            product.set_limit_maps(
+                Limit.from_mongo(limit) for limit in limit_maps
+            )
+
+        return product
+
+    @property
+    def limit_maps(self):
+        # Most pages never use the maps so they are loaded on first access
+        if self._limit_maps is None:
+            self.set_limit_maps(self.get_defined_limit_maps())
+
+        return self._limit_maps
+
+    def set_limit_maps(self, limit_maps):
+        # Only the lazily loaded maps may be filled in after creation
+        object.__setattr__(self, '_limit_maps', tuple(limit_maps))
+
+    def generate_db_name(self):
+        temp = re.sub(' +', ' ', str(self.title.lower().strip()))
+        return re.sub(' ', '_', temp)
+
+    def get_defined_limit_maps(self):
         limit_maps = g.db.limit_maps.find(
             {
                 'product': self.db_name,
                 'active': True
             }
         )
-        if limit_maps.count() > 0:
-            for limit in limit_maps:
-                temp.append(Limit(limit))
+        return [Limit.from_mongo(limit) for limit in limit_maps]
 
-        return temp
 
+def load_limit_maps(products):
+    # Fills in the limit maps for all of the products with one query
+    by_name, found = {}, {}
+    for product in products:
+        by_name.setdefault(product.db_name, []).append(product)
+
+    limit_maps = g.db.limit_maps.find(
+        {
+            'product': {'$in': list(by_name)},
+            'active': True
+        }
+    )
+    for limit in limit_maps:
+        found.setdefault(limit.get('product'), []).append(
+            Limit.from_mongo(limit)
+        )
 
-class Limit:
-    def __init__(self, data):
-        self.product = data.get('product')
-        self.title = normalize(data.get('title'))
-        self.uri = data.get('uri')
-        self.absolute_path = data.get('absolute_path')
-        self.absolute_type = data.get('absolute_type')
-        self.limit_key = data.get('limit_key')
-        self.value_key = data.get('value_key')
-        self.active = bool(data.get('active'))
-        self.id = data.get('_id')
-        self.slug = slug(data.get('title'))
+    for db_name, named in by_name.items():
+        for product in named:
+            product.set_limit_maps(found.get(db_name, []))
 
-    def save_dict(self):
-        temp = self.__dict__
-        del temp['id']
-        return temp
+    return products
 
 
-class Region:
-    def __init__(self, data):
-        self.abbreviation = data.get('abbreviation').upper()
-        self.name = data.get('name')
+class Limit(Model):
+    fields = (
+        'product',
+        'title',
+        'uri',
+        'absolute_path',
+        'absolute_type',
+        'limit_key',
+        'value_key',
+        'active',
+        'id',
+        'slug'
+    )
+    __slots__ = fields
+
+    @classmethod
+    def from_mongo(cls, data):
+        return cls(
+            product=data.get('product'),
+            title=normalize(data.get('title')),
+            uri=data.get('uri'),
+            absolute_path=data.get('absolute_path'),
+            absolute_type=data.get('absolute_type'),
+            limit_key=data.get('limit_key'),
+            value_key=data.get('value_key'),
+            active=bool(data.get('active')),
+            id=data.get('_id'),
+            slug=slug(data.get('title'))
+        )
+
+
+class Region(Model):
+    fields = ('abbreviation', 'name')
+    __slots__ = fields
+
+    @classmethod
+    def from_mongo(cls, data):
+        return cls(
+            abbreviation=data.get('abbreviation').upper(),
+            name=data.get('name')
+        )
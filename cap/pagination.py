@@ -0,0 +1,81 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Pagination strategies for the product APIs. Each one takes a fetch
+    function that returns the parsed content for a URL, or a false value
+    on failure, and yields the list of items on every page in order.
+"""
+
+from cap import client
+
+
+def next_link(links):
+    for link in links or []:
+        if link.get('rel') == 'next':
+            return link.get('href')
+
+    if links:
+        return links[0].get('href')
+
+
+def marker_pages(fetch, url, items_key, links_key, limit):
+    # The next page is requested before the current one is handed back
+    pending = client.submit(fetch, url)
+    while pending is not None:
+        content = pending.get()
+        if not content:
+            break
+
+        items = content.get(items_key) or []
+        pending = None
+        if len(items) >= limit:
+            next_url = next_link(content.get(links_key))
+            if next_url:
+                pending = client.submit(fetch, next_url)
+
+        yield items
+
+
+def offset_pages(fetch, url_for, items_key, limit, window=None):
+    """
+        The next offsets are requested speculatively. The window starts at
+        one page and doubles with every full page up to the window size, so
+        small accounts still only cost a single call.
+    """
+    max_window = window or client.page_window()
+    offset, size, pending = 0, 1, []
+    while True:
+        while len(pending) < size:
+            pending.append(client.submit(fetch, url_for(offset, limit)))
+            offset += limit
+
+        content = pending.pop(0).get()
+        if not content:
+            break
+
+        items = content.get(items_key) or []
+        yield items
+        if len(items) < limit:
+            break
+
+        size = min(size * 2, max_window)
+
+
+def read_total(fetch, url_for, total_key):
+    content = fetch(url_for(0, 1))
+    if content:
+        return content.get(total_key) or 0
+
+    return 0
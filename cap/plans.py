@@ -0,0 +1,226 @@
+# Copyright 2016 Dave Kludt
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Active limit maps compiled into a per product extraction plan. Plans,
+    along with the product and limit map catalog they are built from, are
+    cached in the process and dropped when the limit_maps_version in
+    settings changes, which is bumped every time a map or product is
+    changed through the manage views.
+"""
+
+from collections import namedtuple
+from cap.models import Limit
+
+
+import cap.config.celery as config
+import threading
+import time
+
+
+Extraction = namedtuple(
+    'Extraction',
+    'title absolute_type path limit_key value_key'
+)
+RequestPlan = namedtuple('RequestPlan', 'uri us_url uk_url extractions')
+
+_plans, _catalog = {}, {}
+_plans_lock = threading.Lock()
+_version = {'value': None, 'checked': 0}
+
+
+class LimitPlan:
+    def __init__(self, product, limit_maps):
+        self.db_name = product.get('db_name')
+        uris, grouped = [], {}
+        for limit_map in limit_maps:
+            limit = Limit.from_mongo(limit_map)
+            extraction = Extraction(
+                limit.title,
+                limit.absolute_type,
+                tuple(limit.absolute_path.split('.')),
+                limit.limit_key,
+                limit.value_key
+            )
+            if limit.uri not in grouped:
+                grouped[limit.uri] = []
+                uris.append(limit.uri)
+
+            grouped[limit.uri].append(extraction)
+
+        self.requests = tuple(
+            RequestPlan(
+                uri,
+                '%s%s' % (product.get('us_url'), uri),
+                '%s%s' % (product.get('uk_url'), uri),
+                tuple(grouped.get(uri))
+            )
+            for uri in uris
+        )
+
+    def url(self, request, region, ddi):
+        if region in ['uk', 'lon']:
+            temp_url = request.uk_url
+        else:
+            temp_url = request.us_url
+
+        return temp_url.replace('{region}', region).replace('{ddi}', ddi)
+
+    def extract(self, request, content, limits):
+        product_limits = limits.setdefault(self.db_name, {'limits': {}})
+        indexes = {}
+        for item in request.extractions:
+            if item.absolute_type == 'list':
+                # List responses are indexed by name once per response
+                if item.path not in indexes:
+                    indexes[item.path] = index_by_name(
+                        read_path(content, item.path)
+                    )
+
+                index = indexes.get(item.path)
+                if item.limit_key in index:
+                    product_limits['limits'][item.title] = (
+                        index.get(item.limit_key)
+                    )
+
+                continue
+
+            absolute_limits = read_path(content, item.path)
+            if absolute_limits is None:
+                continue
+
+            if item.absolute_type == 'dict':
+                values = product_limits.setdefault('values', {})
+                product_limits['limits'][item.title] = (
+                    absolute_limits.get(item.limit_key)
+                )
+                if item.value_key:
+                    values[item.title] = absolute_limits.get(item.value_key)
+
+        return limits
+
+
+def index_by_name(absolute_limits):
+    index = {}
+    for temp in absolute_limits or []:
+        if temp.get('name') not in index:
+            index[temp.get('name')] = temp.get('value')
+
+    return index
+
+
+def read_path(content, path):
+    for key in path:
+        if not isinstance(content, dict):
+            return None
+
+        content = content.get(key)
+
+    return content
+
+
+def load_catalog(db):
+    # Every product and active limit map in two queries
+    products = dict(
+        (product.get('db_name'), product) for product in db.products.find()
+    )
+    limit_maps = {}
+    for limit_map in db.limit_maps.find({'active': True}):
+        limit_maps.setdefault(limit_map.get('product'), []).append(limit_map)
+
+    return {'products': products, 'limit_maps': limit_maps}
+
+
+def get_catalog(db):
+    check_version(db)
+    catalog = _catalog.get('value')
+    if catalog is None:
+        catalog = load_catalog(db)
+        with _plans_lock:
+            _catalog['value'] = catalog
+
+    return catalog
+
+
+def get_product(db, db_name):
+    return get_catalog(db).get('products').get(db_name)
+
+
+def get_limit_maps(db, db_name):
+    return get_catalog(db).get('limit_maps').get(db_name, [])
+
+
+def compile_plan(db, db_name):
+    product = get_product(db, db_name)
+    if not product:
+        return None
+
+    return LimitPlan(product, get_limit_maps(db, db_name))
+
+
+def check_version(db):
+    interval = getattr(config, 'LIMIT_PLAN_CHECK_INTERVAL', 30)
+    if time.time() - _version.get('checked') < interval:
+        return
+
+    settings = db.settings.find_one({}, {'limit_maps_version': True}) or {}
+    with _plans_lock:
+        version = settings.get('limit_maps_version', 0)
+        if version != _version.get('value'):
+            _plans.clear()
+            _catalog.clear()
+            _version['value'] = version
+
+        _version['checked'] = time.time()
+
+
+def get_plan(db, db_name):
+    check_version(db)
+    plan = _plans.get(db_name)
+    if plan is None:
+        plan = compile_plan(db, db_name)
+        if plan:
+            with _plans_lock:
+                _plans[db_name] = plan
+
+    return plan
+
+
+def clear():
+    with _plans_lock:
+        _plans.clear()
+        _catalog.clear()
+        _version['checked'] = 0
+
+
+def invalidate(db):
+    db.settings.update({}, {'$inc': {'limit_maps_version': 1}})
+    clear()
+
+
+def shared_urls(db, products, region, ddi):
+    # Limits URLs that more than one of the queried products needs
+    consumers = {}
+    for product in products:
+        plan = get_plan(db, product)
+        if not plan:
+            continue
+
+        for request in plan.requests:
+            url = plan.url(request, region, ddi)
+            consumers.setdefault(url, set()).add(product)
+
+    return sorted(
+        url for url, needed_by in consumers.items() if len(needed_by) > 1
+    )
@@ -13,20 +13,24 @@
 # limitations under the License.
 
 
+from celery.signals import worker_process_shutdown, task_postrun
 from celery.utils.log import get_task_logger
 from future.utils import iteritems
 from bson.objectid import ObjectId
 from happymongo import HapPyMongo
-from functools import reduce
-from cap.models import Limit
-from operator import getitem
+from dateutil import parser
 from celery import Celery
+from cap import client, cache, pagination, plans, breaker, limiter, hedging
 
 
 import cap.config.celery as config
+import datetime
 import requests
+import calendar
+import hashlib
 import json
-import re
+import time
+import uuid
 
 
 # Disable requests warnings from urllib3
@@ -37,35 +41,208 @@ celery_app = Celery('cap')
 logger = get_task_logger(__name__)
 celery_app.config_from_object(config)
 mongo, db = HapPyMongo(config)
+PAGE_LIMIT = 100
+# Identity answers these when the token or DDI itself is wrong
+AUTH_FAILURE_STATUSES = (401, 403, 404)
+flavor_catalogs = cache.TTLCache(getattr(config, 'FLAVOR_CACHE_TTL', 3600))
+validated_tokens = cache.TTLCache(getattr(config, 'TOKEN_CACHE_TTL', 300))
+expiry_indexes = set()
+queue_depths = cache.TTLCache(getattr(config, 'QUEUE_DEPTH_TTL', 5))
+in_flight = client.SingleFlight()
+
+
+@worker_process_shutdown.connect
+def close_upstream_sessions(**kwargs):
+    client.close_sessions()
+
+
+@task_postrun.connect
+def clear_deadline(**kwargs):
+    # The next task run by this worker thread starts without a deadline
+    client.set_deadline(None)
+    client.set_account(None)
+
+
+def send_api_request(url, verb, data, headers):
+    # Identical GETs running at the same time in this worker share one call
+    if (
+        verb.lower() == 'get' and not data and
+        getattr(config, 'COALESCE_UPSTREAM_CALLS', True)
+    ):
+        return in_flight.do(
+            (url, (headers or {}).get('X-Auth-Token')),
+            call_api,
+            url,
+            verb,
+            data,
+            headers
+        )
 
+    return call_api(url, verb, data, headers)
+
+
+def breaker_collection():
+    collection = getattr(config, 'BREAKER_COLLECTION', None)
+    if collection:
+        return db[collection]
+
+    return None
+
+
+def limiter_collection():
+    collection = getattr(config, 'LIMITER_COLLECTION', None)
+    if collection:
+        # Calls still go out when the index cannot be made yet
+        try:
+            ensure_expiry_index(collection)
+        except Exception as e:
+            logger.error('Unable to index %s: %s' % (collection, e))
+
+        return db[collection]
+
+    return None
+
+
+def call_api(url, verb, data, headers):
+    session = client.get_session(url)
+    circuit = breaker.get_breaker(url)
+    window = limiter.get_limiter(url, client.current_account())
+    attempt = 0
+    while True:
+        if client.expired():
+            return client.RequestFailure('deadline', url)
+
+        # Calls wait for a slot under the account's limit for this host
+        started = window.acquire(client.remaining(), limiter_collection())
+        if started is None:
+            return client.RequestFailure('deadline', url)
+
+        # The slot is given back here on every way out, unless it was
+        # handed to a hedged send which gives it back when its call ends
+        response, handed_off = client.RequestFailure('error', url), False
+        try:
+            # Calls to a host that keeps failing are not made until it
+            # recovers. This comes after the wait so a half open probe is
+            # always sent.
+            if not circuit.allow(breaker_collection()):
+                response = client.RequestFailure('degraded', url)
+                return response
+
+            if hedging.enabled() and verb.lower() == 'get' and not data:
+                delay = hedging.hedge_delay(url)
+                handed_off = True
+                response = send_hedged(
+                    session, url, verb, data, headers, window, started, delay
+                )
+            else:
+                response = send_once(session, url, verb, data, headers)
+        finally:
+            if not handed_off:
+                window.release(started, response, limiter_collection())
+
+        circuit.record(
+            not breaker.host_failed(response),
+            breaker_collection()
+        )
+        delay = client.retry_delay(attempt, response)
+        if delay is None:
+            return response
 
-def process_api_request(url, verb, data, headers, status=None):
-    try:
-        if data:
-            response = getattr(requests, verb.lower())(
-                url,
-                headers=headers,
-                data=json.dumps(data),
-                verify=False
+        logger.warning(
+            'Retrying %s in %.2f seconds' % (client.loggable_url(url), delay)
+        )
+        time.sleep(delay)
+        attempt += 1
+
+
+def send_tracked(session, url, verb, data, headers, window, started):
+    response = send_once(session, url, verb, data, headers)
+    window.release(started, response, limiter_collection())
+    if not isinstance(response, client.RequestFailure):
+        hedging.record_latency(url, time.time() - started)
+
+    return response
+
+
+def send_hedged(session, url, verb, data, headers, window, started, delay):
+    # A GET still unanswered at the endpoint's usual latency is sent again
+    if delay is None:
+        return send_tracked(
+            session, url, verb, data, headers, window, started
+        )
+
+    race = client.Race()
+    race.start(
+        send_tracked, session, url, verb, data, headers, window, started
+    )
+    if not race.wait(delay) and hedging.take_hedge():
+        # The hedge only goes out when the account has a slot to spare
+        hedge_started = window.acquire(0, limiter_collection())
+        if hedge_started is not None:
+            logger.info(
+                'Hedging %s after %.2f seconds' % (
+                    client.loggable_url(url),
+                    delay
+                )
             )
-        else:
-            response = getattr(requests, verb.lower())(
-                url,
-                headers=headers,
-                verify=False
+            race.start(
+                send_tracked,
+                session, url, verb, data, headers, window, hedge_started
             )
 
+    race.wait()
+    return race.winner()
+
+
+def send_once(session, url, verb, data, headers):
+    kwargs = {
+        'headers': headers,
+        'verify': False,
+        'timeout': client.timeouts()
+    }
+    if data:
+        kwargs['data'] = json.dumps(data)
+
+    # Exception messages carry the full URL, so only the type is kept
+    try:
+        return getattr(session, verb.lower())(url, **kwargs)
+    except requests.exceptions.Timeout as e:
+        kind, error = 'timeout', e
+    except requests.exceptions.ConnectionError as e:
+        kind, error = 'connection', e
     except Exception as e:
-        logger.error('An error occured executing the API call: %s' % e)
+        kind, error = 'error', e
+
+    failure = client.RequestFailure(
+        kind,
+        url,
+        message='%s calling %s' % (
+            error.__class__.__name__,
+            client.loggable_url(url)
+        )
+    )
+    logger.error(
+        'An error occured executing the API call: %s' % failure.message
+    )
+    return failure
+
+
+def process_api_request(url, verb, data, headers, status=None):
+    response = send_api_request(url, verb, data, headers)
+    if isinstance(response, client.RequestFailure):
+        return response
 
     try:
-        if status and response:
+        if status:
             return response.status_code
 
+        if not response.ok:
+            return client.classify_response(url, response)
+
         return json.loads(response.content)
     except Exception as e:
         logger.error('An error occured loading the content: %s' % e)
-        return None
+        return client.RequestFailure('invalid_content', url, message=str(e))
 
 
 def generate_headers(token):
@@ -76,26 +253,31 @@ def generate_headers(token):
     return temp_headers
 
 
-def get_product_and_limits(db_name):
-    temp_product = db.products.find_one({'db_name': db_name})
-    temp_maps = {}
-    limit_maps = db.limit_maps.find(
-        {
-            'product': db_name,
-            'active': True
-        }
-    )
-    if limit_maps.count() > 0:
-        for limit in limit_maps:
-            try:
-                temp_maps[limit.get('uri')].append(Limit(limit))
-            except:
-                temp_maps[limit.get('uri')] = [Limit(limit)]
+def record_to(failures, failure):
+    # Callers that do not collect failures pass None
+    if failures is not None:
+        failures.append(failure)
+
+
+def api_getter(token, failures=None):
+    # Failed calls are added to failures, pagination just stops on them
+    headers = generate_headers(token)
+
+    def fetch(url):
+        content = process_api_request(url, 'get', None, headers)
+        if isinstance(content, client.RequestFailure):
+            record_to(failures, content)
+
+        return content
 
-    return temp_product, temp_maps
+    return fetch
 
 
-def write_query_log(limits, log_id):
+def write_query_log(limits, log_id, log_region=None):
+    # All region queries tag each entry so the regions can be told apart
+    if log_region:
+        limits = dict(limits, region=log_region)
+
     db.query_logs.update(
         {
             '_id': ObjectId(log_id)
@@ -107,88 +289,158 @@ def write_query_log(limits, log_id):
     )
 
 
-def generate_limit_url(product, uri, region, ddi):
-    if region in ['uk', 'lon']:
-        temp_url = product.get('uk_url')
-    else:
-        temp_url = product.get('us_url')
-
-    return '%s%s' % (
-        re.sub('(\{(region)\})', region, temp_url),
-        re.sub('(\{(ddi)\})', ddi, uri)
+def iterate_server_pages(ddi, token, region, failures=None):
+    url = (
+        'https://%s.servers.api.rackspacecloud.com/v2/%s/'
+        'servers/detail?limit=%d' % (
+            region.lower(),
+            ddi,
+            PAGE_LIMIT
+        )
+    )
+    return pagination.marker_pages(
+        api_getter(token, failures),
+        url,
+        'servers',
+        'servers_links',
+        PAGE_LIMIT
     )
 
 
-def generate_server_list(ddi, token, region):
-    exit, all_servers, limit, marker = False, [], 100, None
-    headers = generate_headers(token)
-    while exit is False:
-        if marker is None:
-            url = (
-                'https://%s.servers.api.rackspacecloud.com/v2/%s/'
-                'servers/detail?limit=%d' % (
-                    region.lower(),
-                    ddi,
-                    limit
-                )
-            )
-        else:
-            url = marker
-
-        content = process_api_request(url, 'get', None, headers)
-        if not content:
-            break
+def iterate_network_pages(token, region, failures=None):
+    url = (
+        'https://%s.networks.api.rackspacecloud.com/v2.0/networks'
+        '?limit=%d' % (
+            region.lower(),
+            PAGE_LIMIT
+        )
+    )
+    return pagination.marker_pages(
+        api_getter(token, failures),
+        url,
+        'networks',
+        'network_links',
+        PAGE_LIMIT
+    )
 
-        servers = content.get('servers')
-        if len(servers) < limit:
-            exit = True
-        else:
-            links = content.get('servers_links')[0]
-            marker = links.get('href')
 
+def generate_server_list(ddi, token, region):
+    all_servers = []
+    for servers in iterate_server_pages(ddi, token, region):
         all_servers += servers
 
     return all_servers
 
 
 def generate_network_list(token, region):
-    exit, all_networks, limit, marker = False, [], 100, None
-    headers = generate_headers(token)
-    while exit is False:
-        if marker is None:
-            url = (
-                'https://%s.networks.api.rackspacecloud.com/v2.0/networks'
-                '?limit=%d' % (
-                    region.lower(),
-                    limit
-                )
-            )
-        else:
-            url = marker
+    all_networks = []
+    for networks in iterate_network_pages(token, region):
+        all_networks += networks
 
-        content = process_api_request(url, 'get', None, headers)
-        if not content:
-            break
+    return all_networks
 
-        networks = content.get('networks')
-        if len(networks) < limit:
-            exit = True
-        else:
-            links = content.get('network_links')[0]
-            marker = links.get('href')
 
-        all_networks += networks
+def count_flavors(servers, flavor_counts):
+    for server in servers:
+        flavor_id = server.get('flavor').get('id')
+        flavor_counts[flavor_id] = flavor_counts.get(flavor_id, 0) + 1
 
-    return all_networks
+    return flavor_counts
 
 
-def generate_total_server_ram(servers, ddi, token, region):
-    total_ram, flavors = 0, {}
+def count_servers(ddi, token, region, failures=None):
+    # Only the running totals are kept so each page can be released
+    total_servers, flavor_counts = 0, {}
+    for servers in iterate_server_pages(ddi, token, region, failures):
+        total_servers += len(servers)
+        count_flavors(servers, flavor_counts)
+
+    return total_servers, flavor_counts
+
+
+def count_networks(token, region, failures=None):
+    total_networks = 0
+    for networks in iterate_network_pages(token, region, failures):
+        total_networks += len(networks)
+
+    return total_networks
+
+
+def load_flavor_catalog(ddi, token, region):
+    # Returns the catalog and how many seconds it has left to live
+    catalog = {}
+    collection = getattr(config, 'FLAVOR_CACHE_COLLECTION', None)
+    if collection:
+        stored = db[collection].find_one({'region': region})
+        if stored and stored.get('expires_at', 0) > time.time():
+            for flavor in stored.get('flavors'):
+                catalog[flavor.get('id')] = flavor.get('ram')
+
+            return catalog, stored.get('expires_at') - time.time()
+
+    url = (
+        'https://%s.servers.api.rackspacecloud.com/v2/%s/'
+        'flavors/detail?limit=%d' % (
+            region,
+            ddi,
+            PAGE_LIMIT
+        )
+    )
+    failures = []
+    pages = pagination.marker_pages(
+        api_getter(token, failures),
+        url,
+        'flavors',
+        'flavors_links',
+        PAGE_LIMIT
+    )
+    for flavors in pages:
+        for flavor in flavors:
+            catalog[flavor.get('id')] = int(flavor.get('ram'))
+
+    if failures:
+        # A partial catalog is used for this query but never kept
+        return catalog, 0
+
+    if catalog and collection:
+        db[collection].update(
+            {
+                'region': region
+            }, {
+                '$set': {
+                    'flavors': [
+                        {'id': flavor_id, 'ram': ram}
+                        for flavor_id, ram in iteritems(catalog)
+                    ],
+                    'expires_at': time.time() + flavor_catalogs.ttl
+                }
+            },
+            upsert=True
+        )
+
+    return catalog, flavor_catalogs.ttl
+
+
+def get_flavor_catalog(ddi, token, region):
+    region = region.lower()
+    catalog = flavor_catalogs.get(region)
+    if catalog is None:
+        catalog, ttl = load_flavor_catalog(ddi, token, region)
+        if catalog and ttl > 0:
+            flavor_catalogs.set(region, catalog, ttl)
+
+    return catalog
+
+
+def generate_total_flavor_ram(
+    flavor_counts, ddi, token, region, failures=None
+):
+    total_ram = 0
     headers = generate_headers(token)
-    for server in servers:
-        flavor_info = server.get('flavor')
-        flavor_id = flavor_info.get('id')
+    flavors = get_flavor_catalog(ddi, token, region)
+    for flavor_id, count in iteritems(flavor_counts):
         if not flavors.get(flavor_id):
+            # Retired flavors are left out of the listing but still in use
             flavor_url = (
                 'https://%s.servers.api.rackspacecloud.com/v2/%s/'
                 'flavors/%s' % (
@@ -198,46 +450,65 @@ def generate_total_server_ram(servers, ddi, token, region):
                 )
             )
             content = process_api_request(flavor_url, 'get', None, headers)
-            if content:
-                temp_flavor = content.get('flavor')
-                temp_ram = int(temp_flavor.get('ram'))
-                flavors[flavor_id] = temp_ram
-                total_ram += temp_ram
-        else:
-            total_ram += flavors.get(flavor_id)
+            if not content:
+                if isinstance(content, client.RequestFailure):
+                    record_to(failures, content)
+
+                continue
+
+            temp_flavor = content.get('flavor')
+            flavors[flavor_id] = int(temp_flavor.get('ram'))
+
+        total_ram += flavors.get(flavor_id) * count
 
     return total_ram
 
 
-def gather_all_load_balancers(token, ddi, region):
-    exit, all_lbs, offset, paginate_limit = False, 0, 0, 100
-    headers = generate_headers(token)
-    while exit is False:
-        url = (
+def generate_total_server_ram(servers, ddi, token, region):
+    flavor_counts = count_flavors(servers, {})
+    return generate_total_flavor_ram(flavor_counts, ddi, token, region)
+
+
+def gather_server_totals(ddi, token, region, failures=None):
+    # RAM totals need the server counts so they stay in the same chain
+    total_servers, flavor_counts = count_servers(ddi, token, region, failures)
+    total_ram = generate_total_flavor_ram(
+        flavor_counts,
+        ddi,
+        token,
+        region,
+        failures
+    )
+    return total_servers, total_ram
+
+
+def gather_all_load_balancers(token, ddi, region, failures=None):
+    all_lbs = 0
+
+    def url_for(offset, limit):
+        return (
             'https://%s.loadbalancers.api.rackspacecloud.com/v1.0/%s/'
             'loadbalancers?offset=%d&limit=%d' % (
                 region.lower(),
                 ddi,
                 offset,
-                paginate_limit
+                limit
             )
         )
-        content = process_api_request(url, 'get', None, headers)
-        if not content:
-            break
-
-        lbs = content.get('loadBalancers')
-        if len(lbs) < paginate_limit:
-            exit = True
-        else:
-            offset += paginate_limit
 
+    pages = pagination.offset_pages(
+        api_getter(token, failures),
+        url_for,
+        'loadBalancers',
+        PAGE_LIMIT
+    )
+    for lbs in pages:
         all_lbs += len(lbs)
 
     return all_lbs
 
 
-def gather_autoscale_groups(ddi, token, region):
+def gather_autoscale_groups(ddi, token, region, failures=None):
     all_groups = []
     headers = generate_headers(token)
     url = (
@@ -250,178 +521,530 @@ def gather_autoscale_groups(ddi, token, region):
     content = process_api_request(url, 'get', None, headers)
     if content:
         all_groups = content.get('groups')
+    elif isinstance(content, client.RequestFailure):
+        record_to(failures, content)
 
     return len(all_groups)
 
 
-def gather_dns_domains(ddi, token):
-    all_domains = 0
-    headers = generate_headers(token)
-    url = 'https://dns.api.rackspacecloud.com/v1.0/%s/domains?limit=1' % (
-        ddi
+def gather_dns_domains(ddi, token, failures=None):
+    def url_for(offset, limit):
+        return (
+            'https://dns.api.rackspacecloud.com/v1.0/%s/'
+            'domains?offset=%d&limit=%d' % (
+                ddi,
+                offset,
+                limit
+            )
+        )
+
+    return pagination.read_total(
+        api_getter(token, failures),
+        url_for,
+        'totalEntries'
     )
-    content = process_api_request(url, 'get', None, headers)
-    if content:
-        all_domains = content.get('totalEntries')
 
-    return all_domains
+
+def ensure_expiry_index(collection):
+    # Lets Mongo remove documents once their expires date has passed
+    if collection not in expiry_indexes:
+        db[collection].create_index('expires', expireAfterSeconds=0)
+        expiry_indexes.add(collection)
+
+
+def token_cache_key(ddi, token):
+    return hashlib.sha256(
+        ('%s:%s' % (ddi, token)).encode('utf-8')
+    ).hexdigest()
+
+
+def token_expiration(response):
+    try:
+        content = json.loads(response.content)
+        expires = content.get('access').get('token').get('expires')
+        return calendar.timegm(parser.parse(expires).utctimetuple())
+    except Exception:
+        return None
+
+
+def cache_token(cache_key, expires_at):
+    validated_tokens.set(cache_key, True, expires_at - time.time())
+    collection = getattr(config, 'TOKEN_CACHE_COLLECTION', None)
+    if collection:
+        ensure_expiry_index(collection)
+        db[collection].update(
+            {
+                '_id': cache_key
+            }, {
+                '$set': {
+                    'expires_at': expires_at,
+                    'expires': datetime.datetime.utcfromtimestamp(
+                        expires_at
+                    )
+                }
+            },
+            upsert=True
+        )
+
+
+def check_cached_token(cache_key):
+    if validated_tokens.get(cache_key):
+        return True
+
+    collection = getattr(config, 'TOKEN_CACHE_COLLECTION', None)
+    if collection:
+        stored = db[collection].find_one({'_id': cache_key})
+        if stored and stored.get('expires_at', 0) > time.time():
+            validated_tokens.set(
+                cache_key,
+                True,
+                stored.get('expires_at') - time.time()
+            )
+            return True
+
+    return False
 
 
 def check_authorized(ddi, token):
+    """
+        True for a valid token and False for one identity rejected. When
+        identity could not be asked the RequestFailure is returned, which
+        is false as well but says nothing about the token.
+    """
+    cache_key = token_cache_key(ddi, token)
+    if check_cached_token(cache_key):
+        return True
+
     headers = generate_headers(token)
     url = 'https://identity.api.rackspacecloud.com/v2.0/tokens/%s' % token
-    status_code = process_api_request(url, 'get', None, headers, True)
-    if status_code == 200:
-        return True
+    response = send_api_request(url, 'get', None, headers)
+    if isinstance(response, client.RequestFailure):
+        return response
+    elif response.status_code in AUTH_FAILURE_STATUSES:
+        return False
+    elif response.status_code != 200:
+        return client.classify_response(url, response)
 
-    return False
+    # Never trust a cached validation past the token's own expiry
+    expires_at = time.time() + validated_tokens.ttl
+    token_expires = token_expiration(response)
+    if token_expires:
+        expires_at = min(expires_at, token_expires)
+
+    if expires_at > time.time():
+        cache_token(cache_key, expires_at)
+
+    return True
 
 
-def gather_limits(token, ddi, region, product):
+def gather_limits(token, ddi, region, product, limit_responses=None):
     limits = {}
-    headers = generate_headers(token)
-    product, limit_maps = get_product_and_limits(product)
-    for uri, limit in iteritems(limit_maps):
-        limit_url = generate_limit_url(product, uri, region, ddi)
-        limit_result = process_api_request(limit_url, 'GET', None, headers)
+    plan = plans.get_plan(db, product)
+    if not plan:
+        return limits
+
+    fetch = api_getter(token)
+    for request in plan.requests:
+        limit_url = plan.url(request, region, ddi)
+        if limit_responses and limit_url in limit_responses:
+            limit_result = limit_responses.get(limit_url)
+        else:
+            limit_result = fetch(limit_url)
+
         if not limit_result:
-            break
+            record_failure(limits, plan.db_name, limit_url, limit_result)
+            if getattr(limit_result, 'kind', None) == 'unauthorized':
+                break
 
-        for item in limit:
-            absolute_limits = reduce(
-                getitem,
-                item.absolute_path.split('.'),
-                limit_result
-            )
-            if item.absolute_type == 'dict':
-                try:
-                    limits[product.get('db_name')]['limits'][item.title] = (
-                        absolute_limits.get(item.limit_key)
-                    )
-                    if item.value_key:
-                        limits[product.get('db_name')]['values'][
-                            item.title
-                        ] = absolute_limits.get(item.value_key)
-                except:
-                    limits[product.get('db_name')] = {}
-                    limits[product.get('db_name')]['limits'] = {}
-                    limits[product.get('db_name')]['values'] = {}
-                    limits[product.get('db_name')]['limits'][item.title] = (
-                        absolute_limits.get(item.limit_key)
-                    )
-                    if item.value_key:
-                        limits[product.get('db_name')]['values'][
-                            item.title
-                        ] = absolute_limits.get(item.value_key)
-
-            elif item.absolute_type == 'list':
-                for temp in absolute_limits:
-                    if temp.get('name') == item.limit_key:
-                        try:
-                            limits[product.get('db_name')]['limits'][
-                                item.title
-                            ] = temp.get('value')
-                            # Here for a place holder in case it is needed
-                            # if item.value_key:
-                            #     limits[product.get('db_name')]['values'][
-                            #         item.title
-                            #     ] = absolute_limits.get(item.value_key)
-                        except:
-                            limits[product.get('db_name')] = {}
-                            limits[product.get('db_name')]['limits'] = {}
-                            limits[product.get('db_name')]['limits'][
-                                item.title
-                            ] = temp.get('value')
-                            # Here for a place holder in case it is needed
-                            # limits[product.get('db_name')]['values'] = {}
-                            # if item.value_key:
-                            #     limits[product.get('db_name')]['values'][
-                            #         item.title
-                            #     ] = temp.get('total', 0)
-                        break
+            continue
+
+        plan.extract(request, limit_result, limits)
 
     return limits
 
 
-@celery_app.task
-def servers(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
-    total_servers = generate_server_list(ddi, token, region)
-    total_networks = generate_network_list(token, region)
-    total_ram = generate_total_server_ram(total_servers, ddi, token, region)
-    results[product]['values']['Servers'] = len(total_servers)
-    results[product]['values']['Private Networks'] = len(total_networks)
-    results[product]['values']['Ram - MB'] = total_ram
+def record_failure(limits, db_name, url, failure):
+    # Failed calls are listed with the results so the page can say why
+    if not isinstance(failure, client.RequestFailure):
+        failure = client.RequestFailure('empty', url)
+
+    product_limits = limits.setdefault(db_name, {'limits': {}})
+    product_limits.setdefault('values', {})
+    product_limits.setdefault('failures', []).append(failure.to_dict())
+
+
+def record_failures(limits, db_name, failures):
+    for failure in failures:
+        record_failure(limits, db_name, failure.url, failure)
+
+
+def result_cache_key(ddi, region, product):
+    return '%s:%s:%s' % (ddi, str(region).lower(), product)
+
+
+def cache_results(ddi, region, product, results):
+    collection = getattr(config, 'RESULT_CACHE_COLLECTION', None)
+    if not collection:
+        return
+
+    ensure_expiry_index(collection)
+    cached_at = time.time()
+    ttl = getattr(config, 'RESULT_CACHE_TTL', 3600)
+    db[collection].update(
+        {
+            '_id': result_cache_key(ddi, region, product)
+        }, {
+            '$set': {
+                'results': results,
+                'cached_at': cached_at,
+                'expires': datetime.datetime.utcfromtimestamp(
+                    cached_at + ttl
+                )
+            }
+        },
+        upsert=True
+    )
+
+
+def get_cached_results(ddi, region, product):
+    collection = getattr(config, 'RESULT_CACHE_COLLECTION', None)
+    if not collection:
+        return None
+
+    # The TTL monitor only runs periodically so expiry is checked here too
+    return db[collection].find_one(
+        {
+            '_id': result_cache_key(ddi, region, product),
+            'expires': {'$gt': datetime.datetime.utcnow()}
+        }
+    )
+
+
+def claim_refresh(ddi, region, product):
+    # Only one query at a time refreshes a stale result
+    now = time.time()
+    claimed = db[getattr(config, 'RESULT_CACHE_COLLECTION')].update(
+        {
+            '_id': result_cache_key(ddi, region, product),
+            'refresh_at': {'$not': {'$gt': now}}
+        }, {
+            '$set': {
+                'refresh_at': now + getattr(config, 'RESULT_CACHE_FRESH', 300)
+            }
+        }
+    )
+    return bool(claimed and claimed.get('updatedExisting'))
 
+
+def record_results(results, ddi, region, product, log_id, log_region=None):
     if len(results) > 0:
-        write_query_log(results, log_id)
+        if client.expired():
+            # Calls were cut short by the deadline so the results are partial
+            for product_results in results.values():
+                product_results['incomplete'] = True
+        elif not any(
+            product_results.get('failures')
+            for product_results in results.values()
+        ):
+            # Failed calls are retried by the next query instead of cached
+            cache_results(ddi, region, product, results)
+
+        if log_id:
+            write_query_log(results, log_id, log_region)
+
+
+@celery_app.task
+def servers(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    failures = []
+    results, server_totals, total_networks = client.run_concurrently(
+        (gather_limits, (token, ddi, region, product, limit_responses)),
+        (gather_server_totals, (ddi, token, region, failures)),
+        (count_networks, (token, region, failures))
+    )
+    total_servers, total_ram = server_totals
+    results[product]['values']['Servers'] = total_servers
+    results[product]['values']['Private Networks'] = total_networks
+    results[product]['values']['Ram - MB'] = total_ram
+    record_failures(results, product, failures)
 
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
 @celery_app.task
-def load_balancers(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
-    total_lbs = gather_all_load_balancers(token, ddi, region)
+def load_balancers(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    failures = []
+    results, total_lbs = client.run_concurrently(
+        (gather_limits, (token, ddi, region, product, limit_responses)),
+        (gather_all_load_balancers, (token, ddi, region, failures))
+    )
     results['load_balancers']['values'] = {}
     results['load_balancers']['values']['Total Load Balancers'] = total_lbs
+    record_failures(results, product, failures)
 
-    if len(results) > 0:
-        write_query_log(results, log_id)
-
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
 @celery_app.task
-def cbs(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
-    if len(results) > 0:
-        write_query_log(results, log_id)
-
+def cbs(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    results = gather_limits(token, ddi, region, product, limit_responses)
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
 @celery_app.task
-def big_data(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
+def big_data(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    results = gather_limits(token, ddi, region, product, limit_responses)
     temp_limits = results[product]['limits']
     for limit_title, value in iteritems(results[product]['values']):
         used = temp_limits.get(limit_title) - value
         results[product]['values'][limit_title] = used
 
-    if len(results) > 0:
-        write_query_log(results, log_id)
-
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
 @celery_app.task
-def autoscale(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
-    total_groups = gather_autoscale_groups(ddi, token, region)
+def autoscale(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    failures = []
+    results, total_groups = client.run_concurrently(
+        (gather_limits, (token, ddi, region, product, limit_responses)),
+        (gather_autoscale_groups, (ddi, token, region, failures))
+    )
     results['autoscale']['values']['Max Groups'] = total_groups
+    record_failures(results, product, failures)
 
-    if len(results) > 0:
-        write_query_log(results, log_id)
-
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
 @celery_app.task
-def dns(token, ddi, region, product, log_id):
-    results = gather_limits(token, ddi, region, product)
-    total_domains = gather_dns_domains(ddi, token)
+def dns(
+    token, ddi, region, product, log_id, limit_responses=None, deadline=None,
+    log_region=None
+):
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+    failures = []
+    results, total_domains = client.run_concurrently(
+        (gather_limits, (token, ddi, region, product, limit_responses)),
+        (gather_dns_domains, (ddi, token, failures))
+    )
     results['dns']['values']['Domains'] = total_domains
+    record_failures(results, product, failures)
 
-    if len(results) > 0:
-        write_query_log(results, log_id)
-
+    record_results(results, ddi, region, product, log_id, log_region)
     return results
 
 
+# The products a query can be dispatched to, by their db_name
+product_tasks = {
+    'servers': servers,
+    'load_balancers': load_balancers,
+    'cbs': cbs,
+    'big_data': big_data,
+    'autoscale': autoscale,
+    'dns': dns
+}
+
+
+def fetch_limit_responses(token, urls):
+    fetch = api_getter(token)
+    responses = client.run_concurrently(*[(fetch, (url,)) for url in urls])
+    return dict(
+        (url, response) for url, response in zip(urls, responses) if response
+    )
+
+
+def revoke_query(log_id, products):
+    for product, task_id in products:
+        celery_app.backend.mark_as_revoked(task_id, 'Authentication failed')
+
+    db.query_logs.update(
+        {
+            '_id': ObjectId(log_id)
+        }, {
+            '$set': {
+                'auth_failed': True
+            }
+        }
+    )
+
+
+def fail_query(products, failure):
+    error = RuntimeError(
+        'Unable to verify the token, identity call failed: %s' % failure.kind
+    )
+    for product, task_id in products:
+        celery_app.backend.mark_as_failure(task_id, error)
+
+
+def answer_from_cache(task_id, cached, log_id, stale, log_region=None):
+    results = cached.get('results')
+    for product_results in results.values():
+        product_results['cached_at'] = cached.get('cached_at')
+        product_results['refreshing'] = stale
+
+    celery_app.backend.store_result(task_id, results, 'SUCCESS')
+    write_query_log(results, log_id, log_region)
+
+
+def dispatch_products(
+    token, ddi, region, log_id, products, shared_urls, log_region=None
+):
+    fresh_for = getattr(config, 'RESULT_CACHE_FRESH', 300)
+    dispatches = []
+    for product, task_id in products:
+        cached = get_cached_results(ddi, region, product)
+        if not cached:
+            dispatches.append((product, task_id, log_id))
+            continue
+
+        # Stale results are answered right away and refreshed in the back
+        stale = time.time() - cached.get('cached_at', 0) > fresh_for
+        answer_from_cache(task_id, cached, log_id, stale, log_region)
+        if stale and claim_refresh(ddi, region, product):
+            dispatches.append((product, str(uuid.uuid4()), None))
+
+    if not dispatches:
+        return
+
+    # Limits URLs shared by several products are only requested once, and
+    # only when the products still to be fetched share them
+    still_shared = plans.shared_urls(
+        db,
+        [product for product, _, _ in dispatches],
+        region,
+        ddi
+    )
+    limit_responses = fetch_limit_responses(
+        token,
+        [url for url in shared_urls if url in still_shared]
+    )
+    for product, task_id, product_log_id in dispatches:
+        # Background refreshes are not held to the query's deadline
+        deadline = None
+        if product_log_id:
+            deadline = client.current_deadline()
+
+        product_task = product_tasks.get(product)
+        if product_task is None:
+            # Fail the task instead of leaving it pending for the page
+            celery_app.backend.mark_as_failure(
+                task_id,
+                ValueError('Unknown product: %s' % product)
+            )
+            continue
+
+        kwargs = {'limit_responses': limit_responses, 'deadline': deadline}
+        if product_log_id and log_region:
+            kwargs['log_region'] = log_region
+
+        product_task.apply_async(
+            (token, ddi, region, product, product_log_id),
+            kwargs,
+            task_id=task_id
+        )
+
+
+@celery_app.task
+def start_query(
+    token, ddi, region, log_id, products, shared_urls, deadline=None
+):
+    # A slow token check is never cut short into an auth failure
+    authorized = check_authorized(ddi, token)
+    if isinstance(authorized, client.RequestFailure):
+        fail_query(products, authorized)
+        return False
+    elif not authorized:
+        revoke_query(log_id, products)
+        return False
+
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+
+    dispatch_products(token, ddi, region, log_id, products, shared_urls)
+    return True
+
+
+@celery_app.task
+def start_all_regions_query(token, ddi, log_id, regions, deadline=None):
+    # Each entry in regions is a region, its products and its shared URLs
+    dispatches = [
+        dispatch for _, products, _ in regions for dispatch in products
+    ]
+    authorized = check_authorized(ddi, token)
+    if isinstance(authorized, client.RequestFailure):
+        fail_query(dispatches, authorized)
+        return False
+    elif not authorized:
+        revoke_query(log_id, dispatches)
+        return False
+
+    client.set_deadline(deadline)
+    client.set_account(ddi)
+
+    client.run_concurrently(
+        *[
+            (
+                dispatch_products,
+                (token, ddi, region, log_id, products, shared_urls, region)
+            )
+            for region, products, shared_urls in regions
+        ]
+    )
+    return True
+
+
+def queue_depth():
+    depth = queue_depths.get('depth')
+    if depth is None:
+        queue = getattr(config, 'CELERY_DEFAULT_QUEUE', 'celery')
+        try:
+            with celery_app.connection(connect_timeout=1) as connection:
+                connection.ensure_connection(max_retries=1)
+                depth = connection.default_channel.queue_declare(
+                    queue=queue,
+                    passive=True
+                ).message_count
+        except Exception as e:
+            logger.error('Unable to read the queue depth: %s' % e)
+            depth = 0
+
+        queue_depths.set('depth', depth)
+
+    return depth
+
+
 @celery_app.task
 def check_auth_token(ddi, token):
-    return check_authorized(ddi, token)
+    return check_authorized(ddi, token) is True
 
 
 @celery_app.task
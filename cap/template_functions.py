@@ -14,35 +14,57 @@
 
 
 from cap.models import Product
+from cap import plans
 from flask import g
 
 
+import time
+
+
+def request_memo(name, key, load):
+    # Lookups are kept for the rest of the request once made
+    memo = getattr(g, 'template_memo', None)
+    if memo is None:
+        memo = g.template_memo = {}
+
+    if (name, key) not in memo:
+        memo[(name, key)] = load()
+
+    return memo.get((name, key))
+
+
 def view_functions():
 
     def get_product_title(db_name):
-        temp_product = g.db.products.find_one({'db_name': db_name})
-        if temp_product:
-            return temp_product.get('title')
-        return ''
+        def load():
+            temp_product = plans.get_product(g.db, db_name)
+            if temp_product:
+                return temp_product.get('title')
+            return ''
+
+        return request_memo('product_title', db_name, load)
 
     def get_limit_maps(product):
-        limit_maps = g.db.limit_maps.find(
-            {
-                'product': product.get('db_name'),
-                'active': True
-            }
+        db_name = product.get('db_name')
+        return request_memo(
+            'limit_maps',
+            db_name,
+            lambda: plans.get_limit_maps(g.db, db_name)
         )
-        return limit_maps
 
     def generate_product_data(results):
-        temp_product = g.db.products.find_one(
-            {
-                'db_name': list(results)[0]
-            }
-        )
-        if temp_product:
-            return Product(temp_product)
-        return None
+        db_name = list(results)[0]
+
+        def load():
+            temp_product = plans.get_product(g.db, db_name)
+            if temp_product:
+                return Product.from_mongo(
+                    temp_product,
+                    plans.get_limit_maps(g.db, db_name)
+                )
+            return None
+
+        return request_memo('product_data', db_name, load)
 
     def determine_color_class(limit, used):
         percentage = float(used/float(limit))
@@ -55,9 +77,48 @@ def view_functions():
             css_class = 'text-warning limit-alert-text-warning'
         return display_percentage, css_class
 
+    def describe_age(timestamp):
+        minutes = int(max(0, time.time() - timestamp) // 60)
+        if minutes < 1:
+            return 'less than a minute ago'
+        elif minutes < 60:
+            return '%d minute%s ago' % (minutes, '' if minutes == 1 else 's')
+
+        hours = minutes // 60
+        return '%d hour%s ago' % (hours, '' if hours == 1 else 's')
+
+    def describe_failure(failure):
+        reasons = {
+            'timeout': 'The API did not respond in time',
+            'connection': 'The API could not be reached',
+            'rate_limited': 'The API is rate limiting requests',
+            'unavailable': 'The API is temporarily unavailable',
+            'unauthorized': 'The token is not authorized for these limits',
+            'not_found': 'The limits could not be found',
+            'deadline': 'The query ran out of time',
+            'degraded': 'Region degraded, calls are paused while it recovers'
+        }
+        reason = reasons.get(
+            failure.get('kind'),
+            'The limits could not be retrieved'
+        )
+        if failure.get('status'):
+            return '%s (%s)' % (reason, failure.get('status'))
+
+        return reason
+
+    def is_degraded(product_results):
+        return any(
+            failure.get('kind') == 'degraded'
+            for failure in product_results.get('failures', [])
+        )
+
     return dict(
         get_product_title=get_product_title,
         get_limit_maps=get_limit_maps,
         generate_product_data=generate_product_data,
-        determine_color_class=determine_color_class
+        determine_color_class=determine_color_class,
+        describe_age=describe_age,
+        describe_failure=describe_failure,
+        is_degraded=is_degraded
     )
@@ -14,18 +14,311 @@
 
 
 from flask import (
-    render_template, request, redirect, g, flash, url_for, jsonify
+    render_template, request, redirect, g, flash, url_for, jsonify,
+    current_app, Response, stream_with_context
 )
+from future.utils import iteritems, string_types, integer_types
 from flask_cloudadmin.decorators import check_perms
 from cap.models import Region, Product, Limit
 from flask_classy import FlaskView, route
-from cap import forms, helper, tasks
+from cap import forms, helper, plans, tasks
 from bson.objectid import ObjectId
-from future.utils import iteritems
 
 
+import hashlib
 import pymongo
 import copy
+import json
+import time
+import uuid
+
+
+AUTH_FAILURE_MESSAGE = (
+    '<strong>Error!</strong> Authentication has failed due to incorrect'
+    ' token or DDI. Please check the token and DDI and try again.'
+)
+
+PENDING_STATES = ['PENDING', 'STARTED', 'RETRY', 'PROGRESS']
+
+
+def task_status(task_id):
+    return task_response(tasks.check_tasks(task_id))
+
+
+def task_response(task):
+    if task.state == 'PENDING':
+        response = {
+            'state': task.state,
+        }
+    elif task.state not in ['FAILURE', 'REVOKED']:
+        response = {
+            'state': task.state,
+        }
+        if task.info:
+            response['result'] = render_template(
+                '_limit_results.html',
+                data=task.info
+            )
+            degraded = degraded_urls(task.info)
+            if degraded:
+                response['degraded'] = degraded
+    elif task.state == 'REVOKED':
+        response = {
+            'state': task.state,
+            'status': AUTH_FAILURE_MESSAGE
+        }
+    else:
+        # Something went horribly wrong
+        response = {
+            'state': task.state,
+            'status': str(task.info)  # Error from task
+        }
+
+    return response
+
+
+def degraded_urls(results):
+    # Calls skipped because the breaker for their host was open
+    hosts = set()
+    for product_results in results.values():
+        if not isinstance(product_results, dict):
+            continue
+
+        for failure in product_results.get('failures', []):
+            if failure.get('kind') == 'degraded':
+                hosts.add(failure.get('url'))
+
+    return sorted(hosts)
+
+
+def progress_info(task):
+    if task.state == 'PROGRESS':
+        return task.info
+
+    return None
+
+
+def state_etag(*items):
+    return hashlib.sha1(
+        json.dumps(items, sort_keys=True).encode('utf-8')
+    ).hexdigest()
+
+
+def poll_interval(states):
+    # Queued tasks wait on the ones ahead of them so polling slows down
+    minimum = current_app.config.get('POLL_INTERVAL_MIN', 1000)
+    maximum = current_app.config.get('POLL_INTERVAL_MAX', 10000)
+    if 'PENDING' not in states:
+        return minimum
+
+    return min(maximum, minimum + tasks.queue_depth() * 250)
+
+
+def conditional_response(etag, states, build):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+
+    response.set_etag(etag)
+    response.headers['X-Poll-Interval'] = str(poll_interval(states))
+    return response
+
+
+def query_deadline():
+    # Every task and upstream call for the query has to finish by this time
+    return time.time() + current_app.config.get('QUERY_DEADLINE', 60)
+
+
+def unknown_products(products):
+    # Products without a task to gather them can never be answered
+    return [
+        product for product in products
+        if product not in tasks.product_tasks
+    ]
+
+
+def start_account_query(token, ddi, region, products, log_data):
+    dispatches = [(product, str(uuid.uuid4())) for product in products]
+    log_id = helper.log_entry(log_data, dict(dispatches))
+    if len(dispatches) > 0:
+        tasks.start_query.delay(
+            token,
+            ddi,
+            region,
+            str(log_id),
+            dispatches,
+            plans.shared_urls(g.db, products, region, ddi),
+            deadline=query_deadline()
+        )
+
+    return str(log_id), dispatches
+
+
+def configured_regions():
+    settings = g.db.settings.find_one() or {}
+    return [
+        region.get('abbreviation').lower()
+        for region in settings.get('regions', [])
+    ]
+
+
+def start_all_regions_query(token, ddi, products, log_data):
+    # Tasks are keyed by product and region so every pair can be tracked
+    regions = configured_regions()
+    region_dispatches = [
+        (region, [(product, str(uuid.uuid4())) for product in products])
+        for region in regions
+    ]
+    dispatches = [
+        ('%s:%s' % (product, region), task_id)
+        for region, products_in_region in region_dispatches
+        for product, task_id in products_in_region
+    ]
+    log_id = helper.log_entry(log_data, dict(dispatches), regions)
+    if len(dispatches) > 0:
+        tasks.start_all_regions_query.delay(
+            token,
+            ddi,
+            str(log_id),
+            [
+                [
+                    region,
+                    products_in_region,
+                    plans.shared_urls(g.db, products, region, ddi)
+                ]
+                for region, products_in_region in region_dispatches
+            ],
+            deadline=query_deadline()
+        )
+
+    return str(log_id), dispatches
+
+
+def region_results(task):
+    # None while pending, the product results on success, otherwise an error
+    if task.state in PENDING_STATES:
+        return None
+    elif task.state == 'SUCCESS':
+        return task.info or {}
+
+    return str(task.info)
+
+
+def account_error(ddi, region, regions, allow_all=False):
+    # Numeric DDIs are accepted and used as strings from here on
+    if not ddi or not region:
+        return 'is missing a DDI or region'
+    elif isinstance(ddi, bool) or not isinstance(
+        ddi,
+        string_types + integer_types
+    ):
+        return 'has an invalid DDI'
+    elif not isinstance(region, string_types) or not (
+        region.lower() in regions or (allow_all and region == 'all')
+    ):
+        return 'has an unknown region: %s' % region
+
+    return None
+
+
+def token_error(token):
+    if not token or not isinstance(token, string_types):
+        return 'A token is required'
+
+    return None
+
+
+def batch_error(accounts):
+    maximum = current_app.config.get('BATCH_MAX_ACCOUNTS', 500)
+    if not isinstance(accounts, list) or len(accounts) == 0:
+        return 'A list of accounts is required'
+    elif len(accounts) > maximum:
+        return 'No more than %d accounts can be queried at once' % maximum
+
+    regions = configured_regions()
+    for index, account in enumerate(accounts):
+        if not isinstance(account, dict):
+            return 'Account %d is not an object' % index
+
+        error = account_error(
+            account.get('ddi'),
+            account.get('region'),
+            regions
+        )
+        if error:
+            return 'Account %d %s' % (index, error)
+
+        products = account.get('products')
+        if not isinstance(products, list) or len(products) == 0:
+            return 'Account %d has no products to query' % index
+
+        for product in products:
+            if not isinstance(product, string_types):
+                return 'Account %d has an invalid product' % index
+
+            found = plans.get_product(g.db, product)
+            if (
+                not found or not found.get('active') or
+                unknown_products([product])
+            ):
+                return 'Account %d has an unknown product: %s' % (
+                    index,
+                    product
+                )
+
+    return None
+
+
+def batch_log_data(token, account):
+    log_data = {
+        'ddi': str(account.get('ddi')),
+        'region': account.get('region'),
+        'token': token
+    }
+    for product in account.get('products'):
+        log_data[product] = 'y'
+
+    return log_data
+
+
+def batch_line(account, log_id, dispatches, timed_out=False):
+    statuses = dict(
+        (product, tasks.check_tasks(task_id))
+        for product, task_id in dispatches
+    )
+    pending = [
+        product for product, task in iteritems(statuses)
+        if task.state in PENDING_STATES
+    ]
+    if pending and not timed_out:
+        return None
+
+    results, errors = {}, {}
+    for product, task in iteritems(statuses):
+        if task.state == 'SUCCESS':
+            results.update(task.info or {})
+        elif task.state == 'REVOKED':
+            errors[product] = 'Authentication failed'
+        elif product in pending:
+            errors[product] = 'Timed out waiting for the results'
+        else:
+            errors[product] = str(task.info)
+
+    return json.dumps(
+        {
+            'ddi': account.get('ddi'),
+            'region': account.get('region'),
+            'query': log_id,
+            'state': 'FAILURE' if errors else 'SUCCESS',
+            'results': results,
+            'errors': errors
+        }
+    ) + '\n'
+
+
+def server_sent_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
 
 
 class BaseView(FlaskView):
@@ -52,62 +345,229 @@ class QueryView(FlaskView):
         )
 
     def post(self):
-        # Confirm token is good before proceeding
-        products, task_ids = [], []
+        # Token is verified as the first stage of the query task pipeline
+        products = []
         ddi = request.json.get('ddi')
         token = request.json.get('token')
         region = request.json.get('region')
-        if tasks.check_auth_token(ddi, token):
-            # Store log entry of query and pass along the id of the record
-            log_data = copy.copy(request.json)
-            log_id = helper.log_entry(log_data)
-            for product, value in iteritems(request.json):
-                if str(value) == 'y':
-                    products.append(product)
-
-            if len(products) > 0:
-                for product in products:
-                    task_id = getattr(tasks, product).delay(
+        error = token_error(token)
+        if not error:
+            error = account_error(ddi, region, configured_regions(), True)
+            if error:
+                error = 'The query %s' % error
+
+        if error:
+            return jsonify(message=error), 400
+
+        ddi = str(ddi)
+        for product, value in iteritems(request.json):
+            if str(value) == 'y':
+                products.append(product)
+
+        unknown = unknown_products(products)
+        if unknown:
+            return jsonify(
+                message='Unknown products: %s' % ', '.join(sorted(unknown))
+            ), 400
+
+        # Store log entry of query and pass along the id of the record
+        if region == 'all':
+            log_id, dispatches = start_all_regions_query(
+                token,
+                ddi,
+                products,
+                copy.copy(request.json)
+            )
+        else:
+            log_id, dispatches = start_account_query(
+                token,
+                ddi,
+                region,
+                products,
+                copy.copy(request.json)
+            )
+
+        task_ids = [{product: task_id} for product, task_id in dispatches]
+        return jsonify(query=log_id, tasks=task_ids), 202
+
+    @route('/batch', methods=['POST'])
+    def post_batch(self):
+        token = request.json.get('token')
+        accounts = request.json.get('accounts') or []
+        error = token_error(token) or batch_error(accounts)
+        if error:
+            return jsonify(message=error), 400
+
+        limit = current_app.config.get('BATCH_CONCURRENCY', 10)
+        interval = current_app.config.get('STREAM_POLL_INTERVAL', 0.5)
+        expires = time.time() + current_app.config.get('BATCH_TIMEOUT', 1800)
+
+        def generate():
+            # Only a bounded number of accounts are in the pipeline at once
+            queued, running = list(accounts), []
+            while (queued or running) and time.time() < expires:
+                while queued and len(running) < limit:
+                    account = queued.pop(0)
+                    log_id, dispatches = start_account_query(
                         token,
-                        ddi,
-                        region,
-                        product,
-                        str(log_id)
+                        str(account.get('ddi')),
+                        account.get('region'),
+                        account.get('products'),
+                        batch_log_data(token, account)
                     )
-                    task_ids.append({product: str(task_id)})
+                    running.append((account, log_id, dispatches))
 
-            return jsonify(tasks=task_ids), 202
-        else:
-            return jsonify(
-                message='<strong>Error!</strong> Authentication has failed'
-                ' due to incorrect token or DDI. Please check'
-                ' the token and DDI and try again.'
-            ), 401
+                for item in list(running):
+                    line = batch_line(*item)
+                    if line:
+                        running.remove(item)
+                        yield line
+
+                if running:
+                    time.sleep(interval)
+
+            for account, log_id, dispatches in running:
+                yield batch_line(account, log_id, dispatches, timed_out=True)
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
 
     @route('/status/<task_id>')
     def get_task_status(self, task_id):
         task = tasks.check_tasks(task_id)
-        if task.state == 'PENDING':
-            response = {
-                'state': task.state,
-            }
-        elif task.state != 'FAILURE':
-            response = {
-                'state': task.state,
+        return conditional_response(
+            state_etag(task_id, task.state, progress_info(task)),
+            [task.state],
+            lambda: task_response(task)
+        )
+
+    @route('/results/<query_id>')
+    def get_query_status(self, query_id):
+        query = g.db.query_logs.find_one({'_id': ObjectId(query_id)})
+        if not query:
+            return jsonify(message='Query could not be found'), 404
+
+        if query.get('auth_failed'):
+            return jsonify(state='REVOKED', status=AUTH_FAILURE_MESSAGE)
+
+        # Products the page already has are not looked up again
+        seen = request.args.get('seen', '').split(',')
+        query_tasks = {}
+        for product, task_id in iteritems(query.get('tasks', {})):
+            if product not in seen:
+                query_tasks[product] = tasks.check_tasks(task_id)
+
+        states = [task.state for task in query_tasks.values()]
+        state = 'SUCCESS'
+        if set(states).intersection(PENDING_STATES):
+            state = 'PENDING'
+
+        return conditional_response(
+            state_etag(
+                query_id,
+                sorted(
+                    (product, task.state, progress_info(task))
+                    for product, task in iteritems(query_tasks)
+                )
+            ),
+            states,
+            lambda: {
+                'state': state,
+                'tasks': dict(
+                    (product, task_response(task))
+                    for product, task in iteritems(query_tasks)
+                )
             }
-            if task.info:
-                response['result'] = render_template(
-                    '_limit_results.html',
-                    data=task.info
+        )
+
+    @route('/compare/<query_id>')
+    def get_region_comparison(self, query_id):
+        query = g.db.query_logs.find_one({'_id': ObjectId(query_id)})
+        if not query:
+            return jsonify(message='Query could not be found'), 404
+
+        if query.get('auth_failed'):
+            return jsonify(state='REVOKED', status=AUTH_FAILURE_MESSAGE)
+
+        by_product = {}
+        for key, task_id in iteritems(query.get('tasks', {})):
+            product, region = key.split(':', 1)
+            by_product.setdefault(product, {})[region] = (
+                tasks.check_tasks(task_id)
+            )
+
+        states = [
+            task.state
+            for region_tasks in by_product.values()
+            for task in region_tasks.values()
+        ]
+        state = 'SUCCESS'
+        if set(states).intersection(PENDING_STATES):
+            state = 'PENDING'
+
+        return conditional_response(
+            state_etag(
+                query_id,
+                sorted(
+                    (product, region, task.state)
+                    for product, region_tasks in iteritems(by_product)
+                    for region, task in iteritems(region_tasks)
+                )
+            ),
+            states,
+            lambda: {
+                'state': state,
+                'products': dict(
+                    (
+                        product,
+                        render_template(
+                            '_region_comparison.html',
+                            db_name=product,
+                            regions=query.get('regions', []),
+                            results=dict(
+                                (region, region_results(task))
+                                for region, task in iteritems(region_tasks)
+                            )
+                        )
+                    )
+                    for product, region_tasks in iteritems(by_product)
                 )
-        else:
-            # Something went horribly wrong
-            response = {
-                'state': task.state,
-                'status': str(task.info)  # Error from task
             }
+        )
 
-        return jsonify(response)
+    @route('/stream/<query_id>')
+    def stream_query_results(self, query_id):
+        query = g.db.query_logs.find_one({'_id': ObjectId(query_id)})
+        if not query:
+            return jsonify(message='Query could not be found'), 404
+
+        interval = current_app.config.get('STREAM_POLL_INTERVAL', 0.5)
+        expires = time.time() + current_app.config.get('STREAM_TIMEOUT', 300)
+
+        def generate():
+            # Results are checked here so the page never has to poll
+            pending = dict(query.get('tasks', {}))
+            while pending and time.time() < expires:
+                for product, task_id in list(pending.items()):
+                    status = task_status(task_id)
+                    if status.get('state') not in PENDING_STATES:
+                        del pending[product]
+                        status['product'] = product
+                        yield server_sent_event('result', status)
+
+                if pending:
+                    time.sleep(interval)
+
+            yield server_sent_event('complete', {'pending': list(pending)})
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
 
 
 class GlobalManageView(FlaskView):
@@ -119,14 +579,14 @@ class GlobalManageView(FlaskView):
         settings = g.db.settings.find_one()
         form = forms.RegionSet()
         if request.method == 'POST' and form.validate_on_submit():
-            region = Region(request.form)
+            region = Region.from_mongo(request.form)
             if settings.get('regions'):
                 g.db.settings.update(
                     {
                         '_id': settings.get('_id')
                     }, {
                         '$push': {
-                            'regions': region.__dict__
+                            'regions': region.save_dict()
                         }
                     }
                 )
@@ -136,7 +596,7 @@ class GlobalManageView(FlaskView):
                         '_id': settings.get('_id')
                     }, {
                         '$set': {
-                            'regions': [region.__dict__]
+                            'regions': [region.save_dict()]
                         }
                     }
                 )
@@ -166,7 +626,7 @@ class GlobalManageView(FlaskView):
         if limit_id:
             limit = g.db.limit_maps.find_one({'_id': ObjectId(limit_id)})
             if limit:
-                limit = Limit(limit)
+                limit = Limit.from_mongo(limit)
                 form = forms.LimitMap(obj=limit)
             else:
                 flash('Could not find the specified limit', 'error')
@@ -181,7 +641,7 @@ class GlobalManageView(FlaskView):
         ]
         form.product.choices.insert(0, ('', ''))
         if request.method == 'POST' and form.validate_on_submit():
-            save_limit = Limit(request.form)
+            save_limit = Limit.from_mongo(request.form)
             if limit_id:
                 g.db.limit_maps.update(
                     {
@@ -197,6 +657,7 @@ class GlobalManageView(FlaskView):
                 )
                 flash('Limit successfully added', 'success')
 
+            plans.invalidate(g.db)
             return redirect('/manage/limits')
         else:
             if request.method == 'POST':
@@ -239,11 +700,11 @@ class GlobalManageView(FlaskView):
             form = forms.ManageProduct(obj=product_data)
 
         if request.method == 'POST' and form.validate_on_submit():
-            to_save = Product(request.form.to_dict())
+            to_save = Product.from_mongo(request.form.to_dict())
             if product_data and product_data.db_name:
-                to_save.db_name = product_data.db_name
+                to_save = to_save.replace(db_name=product_data.db_name)
             else:
-                to_save.set_db_name()
+                to_save = to_save.replace(db_name=to_save.generate_db_name())
 
             if product_data:
                 g.db.products.update(
@@ -258,6 +719,7 @@ class GlobalManageView(FlaskView):
                 g.db.products.insert(to_save.save_dict())
                 flash('Product was successfully added', 'success')
 
+            plans.invalidate(g.db)
             return redirect(
                 url_for('GlobalManageView:manage_products', product=product)
             )
@@ -326,6 +788,9 @@ class GlobalManageView(FlaskView):
                             }
                         )
 
+                    if key == 'limits':
+                        plans.invalidate(g.db)
+
                     if item.get('title'):
                         flash(
                             '%s was %sd successfully' % (
@@ -358,6 +823,6 @@ class GlobalManageView(FlaskView):
         product_slug = helper.slug(product.strip())
         temp_product = g.db.products.find_one({'db_name': product_slug})
         if temp_product:
-            return Product(temp_product)
+            return Product.from_mongo(temp_product)
 
         return str(product)
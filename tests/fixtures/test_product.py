@@ -52,6 +52,19 @@ sample_auth_failure = {
     )
 }
 
+token_validate_return = {
+    'access': {
+        'token': {
+            'id': 'token',
+            'expires': '2099-01-01T00:00:00.000Z',
+            'tenant': {
+                'id': '123456',
+                'name': '123456'
+            }
+        }
+    }
+}
+
 """ DNS Tests """
 
 dns = {
@@ -701,6 +714,24 @@ server_flavor_return = {
     }
 }
 
+server_flavor_list_return = {
+    "flavors": [
+        {
+            "ram": 1024,
+            "name": "1 GB General Purpose v1",
+            "vcpus": 1,
+            "disk": 20,
+            "id": "general1-1"
+        }, {
+            "ram": 2048,
+            "name": "2 GB General Purpose v1",
+            "vcpus": 2,
+            "disk": 40,
+            "id": "general1-2"
+        }
+    ]
+}
+
 server_full_return = {
     'servers': {
         'values': {
@@ -14,8 +14,9 @@
 
 
 from fixtures import test_product
-from cap import setup_application
+from cap import setup_application, plans, models
 from cap.config import config
+from flask import g
 from uuid import uuid4
 
 
@@ -44,6 +45,7 @@ class CapManageTests(unittest.TestCase):
 
         self.db.products.remove({})
         self.db.limit_maps.remove({})
+        plans.clear()
 
     def tearDown(self):
         collections = [
@@ -663,6 +665,66 @@ class CapManageTests(unittest.TestCase):
             'DB Name was changed and should not have been'
         )
 
+    def test_product_limit_maps_lazy(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        with self.cap.test_request_context():
+            g.db = self.db
+            product = models.Product.from_mongo(self.db.products.find_one())
+            assert product._limit_maps is None, 'Limit maps loaded eagerly'
+            self.assertEquals(
+                [limit.title for limit in product.limit_maps],
+                ['Test'],
+                'Limit maps were not loaded on first access'
+            )
+            assert 'limit_maps' not in product.save_dict()
+
+    def test_product_limit_maps_bulk_load(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        self.setup_usable_limit(deactivate=True)
+        other = self.db.products.find_one({}, {'_id': False})
+        other['db_name'] = 'other'
+        self.db.products.insert(other)
+        with self.cap.test_request_context():
+            g.db = self.db
+            products = models.load_limit_maps(
+                [
+                    models.Product.from_mongo(item)
+                    for item in self.db.products.find()
+                ]
+            )
+            limit_maps = dict(
+                (product.db_name, product._limit_maps) for product in products
+            )
+
+        self.assertEquals(len(limit_maps.get('test')), 1)
+        self.assertEquals(
+            limit_maps.get('other'),
+            (),
+            'Products without maps were not marked as loaded'
+        )
+
+    def test_models_immutable_round_trip(self):
+        self.setup_usable_limit()
+        document = self.db.limit_maps.find_one()
+        limit = models.Limit.from_mongo(document)
+        with self.assertRaises(AttributeError):
+            limit.title = 'Changed'
+
+        self.assertEquals(
+            models.Limit.from_mongo(limit.to_mongo()),
+            limit,
+            'Limit did not survive a round trip through its document'
+        )
+        self.assertEquals(
+            limit.replace(title='Changed').title,
+            'Changed',
+            'Replace did not return the changed limit'
+        )
+        self.assertEquals(limit.title, 'Test', 'Original limit was changed')
+        assert not hasattr(limit, '__dict__'), 'Limit is not slotted'
+
     def test_manage_product_manage_add_bad_data(self):
         self.db.products.remove({})
         with self.app as c:
@@ -825,6 +887,10 @@ class CapManageTests(unittest.TestCase):
         )
         limit = self.db.limit_maps.find_one()
         assert not limit.get('active'), 'Status was not changed correctly'
+        settings = self.db.settings.find_one()
+        assert settings.get('limit_maps_version'), (
+            'Limit plans were not invalidated after change'
+        )
         self.assertEquals(
             limit.get('title'),
             'Test Edit',
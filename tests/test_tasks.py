@@ -20,8 +20,11 @@ from uuid import uuid4
 
 
 import unittest
+import threading
+import copy
 import uuid
 import json
+import time
 import mock
 import cap
 import re
@@ -48,6 +51,12 @@ class CapCeleryTests(unittest.TestCase):
 
         self.db.products.remove({})
         self.db.limit_maps.remove({})
+        self.tasks.flavor_catalogs.clear()
+        self.tasks.plans.clear()
+        self.tasks.validated_tokens.clear()
+        self.tasks.breaker.clear()
+        self.tasks.limiter.clear()
+        self.tasks.hedging.clear()
 
     def tearDown(self):
         collections = [
@@ -56,7 +65,12 @@ class CapCeleryTests(unittest.TestCase):
             'managers',
             'sessions',
             'limit_maps',
-            'query_logs'
+            'query_logs',
+            'flavor_catalogs',
+            'token_cache',
+            'result_cache',
+            'circuit_breakers',
+            'rate_limits'
         ]
         for c in collections:
             getattr(self.db, c).remove({})
@@ -152,7 +166,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(cloud_return)
                     patched_get.return_value.status_code = 200
                     task = self.tasks.check_auth_token(
@@ -172,7 +186,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     error = patched_get.side_effect = ValueError
                     patched_get.return_value = error
                     task = self.tasks.check_auth_token(
@@ -182,6 +196,43 @@ class CapCeleryTests(unittest.TestCase):
 
         assert task is False, 'Incorrect status returned with check'
 
+    def test_celery_check_token_cached(self):
+        token = uuid.uuid4().hex
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(
+                test_product.token_validate_return
+            )
+            patched_get.return_value.status_code = 200
+            for i in range(2):
+                task = self.tasks.check_auth_token('123456', token)
+
+            self.tasks.validated_tokens.clear()
+            shared = self.tasks.check_auth_token('123456', token)
+
+        assert task is True, 'Incorrect status returned with check'
+        assert shared is True, 'Incorrect status returned with shared check'
+        self.assertEqual(
+            patched_get.call_count,
+            1,
+            'Validated token was not served from the cache'
+        )
+
+    def test_celery_check_token_expired_not_cached(self):
+        expired = copy.deepcopy(test_product.token_validate_return)
+        expired['access']['token']['expires'] = '2016-01-01T00:00:00.000Z'
+        token = uuid.uuid4().hex
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(expired)
+            patched_get.return_value.status_code = 200
+            for i in range(2):
+                self.tasks.check_auth_token('123456', token)
+
+        self.assertEqual(
+            patched_get.call_count,
+            2,
+            'Token was cached past its own expiry'
+        )
+
     def test_process_data_json_success(self):
         cloud_return = {'servers': []}
         with self.app.test_client() as c:
@@ -193,7 +244,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(cloud_return)
                     patched_get.return_value.status_code = 200
                     task = self.tasks.process_api_request(
@@ -206,6 +257,95 @@ class CapCeleryTests(unittest.TestCase):
 
         assert cloud_return == task, 'Return value did not match'
 
+    def test_process_api_request_reuses_host_session(self):
+        first = self.tasks.client.get_session(
+            'https://dfw.servers.api.rackspacecloud.com/v2/123456/limits'
+        )
+        second = self.tasks.client.get_session(
+            'https://DFW.servers.api.rackspacecloud.com/v2/123456/servers'
+        )
+        other = self.tasks.client.get_session(
+            'https://dfw.networks.api.rackspacecloud.com/v2.0/networks'
+        )
+        assert first is second, 'Session was not reused for the same host'
+        assert first is not other, 'Session was shared across hosts'
+
+    def test_run_concurrently_preserves_order(self):
+        results = self.tasks.client.run_concurrently(
+            (pow, (2, 3)),
+            (max, (1, 5)),
+            (min, (4, 2))
+        )
+        self.assertEqual(results, [8, 5, 2], 'Results returned out of order')
+
+    def test_run_concurrently_disabled(self):
+        with mock.patch(
+            'cap.tasks.config.CONCURRENT_UPSTREAM_CALLS',
+            False,
+            create=True
+        ):
+            results = self.tasks.client.run_concurrently(
+                (threading.current_thread, ()),
+                (threading.current_thread, ())
+            )
+
+        for thread in results:
+            self.assertIs(
+                thread,
+                threading.current_thread(),
+                'Calls were not run in the calling thread'
+            )
+
+    def test_identical_requests_coalesced(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return mock.Mock(content=json.dumps({'limits': {}}))
+
+        with mock.patch('requests.Session.get') as get:
+            get.side_effect = slow_get
+            leader = self.tasks.client.submit(
+                self.tasks.process_api_request,
+                'https://test.com/limits',
+                'get',
+                None,
+                self.tasks.generate_headers('token')
+            )
+            started.wait(5)
+            follower = self.tasks.client.submit(
+                self.tasks.process_api_request,
+                'https://test.com/limits',
+                'get',
+                None,
+                self.tasks.generate_headers('token')
+            )
+            time.sleep(0.1)
+            release.set()
+            results = [leader.get(), follower.get()]
+
+        self.assertEqual(get.call_count, 1, 'Identical calls were not shared')
+        self.assertEqual(results, [{'limits': {}}, {'limits': {}}])
+        self.assertIsNot(
+            results[0],
+            results[1],
+            'Callers were handed the same parsed content'
+        )
+
+    def test_different_tokens_not_coalesced(self):
+        with mock.patch('requests.Session.get') as get:
+            get.return_value.content = json.dumps({'limits': {}})
+            for token in ['first', 'second']:
+                self.tasks.process_api_request(
+                    'https://test.com/limits',
+                    'get',
+                    None,
+                    self.tasks.generate_headers(token)
+                )
+
+        self.assertEqual(get.call_count, 2, 'Calls for other tokens shared')
+
     """ DNS """
 
     def test_dns_success(self):
@@ -221,7 +361,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.dns_limit_return
                     )
@@ -253,7 +393,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.dns_list_return
                     )
@@ -280,7 +420,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.autoscale_limit_return
                     )
@@ -320,7 +460,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.autoscale_list_return
                     )
@@ -348,7 +488,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.big_data_limit_return
                     )
@@ -386,7 +526,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.cbs_limit_return
                     )
@@ -422,7 +562,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.clb_limit_return
                     )
@@ -457,7 +597,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.clb_list_return
                     )
@@ -485,25 +625,21 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.server_limit_return
                     )
                     patched_get.return_value.status_code = 200
                     with mock.patch(
-                        'cap.tasks.generate_server_list'
-                    ) as server_list:
-                        server_list.return_value = (
-                            test_product.server_list_return
-                        )
+                        'cap.tasks.count_servers'
+                    ) as server_count:
+                        server_count.return_value = (1, {'general1-1': 1})
                         with mock.patch(
-                            'cap.tasks.generate_network_list'
-                        ) as network_list:
-                            network_list.return_value = (
-                                test_product.network_processed_list
-                            )
+                            'cap.tasks.count_networks'
+                        ) as network_count:
+                            network_count.return_value = 1
                             with mock.patch(
-                                'cap.tasks.generate_total_server_ram'
+                                'cap.tasks.generate_total_flavor_ram'
                             ) as ram:
                                 ram.return_value = 1024
                                 return_value = self.tasks.servers(
@@ -534,7 +670,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.server_list_return
                     )
@@ -559,7 +695,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.network_list_return
                     )
@@ -583,7 +719,7 @@ class CapCeleryTests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('requests.get') as patched_get:
+                with mock.patch('requests.Session.get') as patched_get:
                     patched_get.return_value.content = json.dumps(
                         test_product.server_flavor_return
                     )
@@ -598,3 +734,1107 @@ class CapCeleryTests(unittest.TestCase):
         assert return_value == 1024, (
             'Did not get expected count return on list'
         )
+
+    def test_generate_total_server_ram_flavor_catalog(self):
+        with self.app.test_client() as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch(
+                'cap.tasks.config.CELERY_ALWAYS_EAGER',
+                True,
+                create=True
+            ):
+                with mock.patch('requests.Session.get') as patched_get:
+                    patched_get.return_value.content = json.dumps(
+                        test_product.server_flavor_list_return
+                    )
+                    patched_get.return_value.status_code = 200
+                    for i in range(2):
+                        return_value = self.tasks.generate_total_server_ram(
+                            test_product.server_list_processed_return,
+                            '123467',
+                            uuid.uuid4().hex,
+                            'DFW'
+                        )
+
+        assert return_value == 1024, (
+            'Did not get expected count return on list'
+        )
+        self.assertEqual(
+            patched_get.call_count,
+            1,
+            'Flavor catalog was not reused across calls'
+        )
+
+    def test_flavor_catalog_persisted(self):
+        with mock.patch(
+            'cap.tasks.config.FLAVOR_CACHE_COLLECTION',
+            'flavor_catalogs',
+            create=True
+        ):
+            with mock.patch('requests.Session.get') as patched_get:
+                patched_get.return_value.content = json.dumps(
+                    test_product.server_flavor_list_return
+                )
+                patched_get.return_value.status_code = 200
+                self.tasks.get_flavor_catalog(
+                    '123467',
+                    uuid.uuid4().hex,
+                    'DFW'
+                )
+                self.tasks.flavor_catalogs.clear()
+                catalog = self.tasks.get_flavor_catalog(
+                    '123467',
+                    uuid.uuid4().hex,
+                    'DFW'
+                )
+
+        self.assertEqual(
+            catalog,
+            {'general1-1': 1024, 'general1-2': 2048},
+            'Flavor catalog did not match the stored flavors'
+        )
+        self.assertEqual(
+            patched_get.call_count,
+            1,
+            'Stored flavor catalog was not used after a restart'
+        )
+
+    def test_stored_flavor_catalog_keeps_expiry(self):
+        self.db.flavor_catalogs.insert(
+            {
+                'region': 'dfw',
+                'flavors': [{'id': 'general1-1', 'ram': 1024}],
+                'expires_at': time.time() + 60
+            }
+        )
+        with mock.patch(
+            'cap.tasks.config.FLAVOR_CACHE_COLLECTION',
+            'flavor_catalogs',
+            create=True
+        ):
+            with mock.patch.object(
+                self.tasks.flavor_catalogs,
+                'set'
+            ) as cached:
+                self.tasks.get_flavor_catalog(
+                    '123467',
+                    uuid.uuid4().hex,
+                    'DFW'
+                )
+
+        ttl = cached.call_args[0][2]
+        assert 0 < ttl <= 60, 'Stored catalog was cached past its expiry'
+
+    def test_count_servers(self):
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(
+                test_product.server_list_return
+            )
+            patched_get.return_value.status_code = 200
+            total_servers, flavor_counts = self.tasks.count_servers(
+                '123467',
+                uuid.uuid4().hex,
+                'DFW'
+            )
+
+        self.assertEqual(total_servers, 1, 'Incorrect server count')
+        self.assertEqual(
+            flavor_counts,
+            {'general1-1': 1},
+            'Incorrect flavor histogram'
+        )
+
+    def test_count_networks(self):
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(
+                test_product.network_list_return
+            )
+            patched_get.return_value.status_code = 200
+            total_networks = self.tasks.count_networks(
+                uuid.uuid4().hex,
+                'DFW'
+            )
+
+        self.assertEqual(
+            total_networks,
+            len(test_product.network_processed_list),
+            'Incorrect network count'
+        )
+
+    def test_offset_pages_multiple_pages(self):
+        def fetch(url):
+            offset = int(re.search('offset=(\\d+)', url).group(1))
+            return {'items': list(range(offset, min(offset + 10, 45)))}
+
+        pages = list(
+            self.tasks.pagination.offset_pages(
+                fetch,
+                lambda offset, limit: 'items?offset=%d&limit=%d' % (
+                    offset,
+                    limit
+                ),
+                'items',
+                10
+            )
+        )
+        self.assertEqual(
+            [len(page) for page in pages],
+            [10, 10, 10, 10, 5],
+            'Offset pages were not returned in order'
+        )
+
+    def test_page_pool_sized_to_window(self):
+        with mock.patch.multiple(
+            self.tasks.config,
+            create=True,
+            UPSTREAM_CONCURRENCY=4,
+            PAGINATION_WINDOW=16
+        ):
+            self.assertEqual(self.tasks.client.pool_threads(0), 4)
+            self.assertEqual(
+                self.tasks.client.pool_threads(1),
+                16,
+                'Page fetches were not given the full window'
+            )
+
+    def test_http_pool_covers_calling_threads(self):
+        with mock.patch.multiple(
+            self.tasks.config,
+            create=True,
+            HTTP_POOL_SIZE=None,
+            CELERYD_CONCURRENCY=2,
+            UPSTREAM_CONCURRENCY=4,
+            PAGINATION_WINDOW=40,
+            LIMITER_MAX=32
+        ):
+            self.assertEqual(
+                self.tasks.client.pool_size(),
+                44,
+                'Keep-alive pool is smaller than the calling threads'
+            )
+
+    def test_marker_pages_follow_next_link(self):
+        responses = {
+            'page1': {
+                'items': [1, 2],
+                'links': [{'rel': 'next', 'href': 'page2'}]
+            },
+            'page2': {
+                'items': [3],
+                'links': []
+            }
+        }
+        pages = list(
+            self.tasks.pagination.marker_pages(
+                responses.get,
+                'page1',
+                'items',
+                'links',
+                2
+            )
+        )
+        self.assertEqual(pages, [[1, 2], [3]], 'Marker pages did not match')
+
+    def test_gather_limits_uses_cached_plan(self):
+        self.db.products.insert(test_product.dns)
+        self.db.limit_maps.insert(test_product.dns_limit)
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(
+                test_product.dns_limit_return
+            )
+            patched_get.return_value.status_code = 200
+            first = self.tasks.gather_limits(
+                uuid.uuid4().hex,
+                '123467',
+                'DFW',
+                'dns'
+            )
+            self.db.limit_maps.remove({})
+            second = self.tasks.gather_limits(
+                uuid.uuid4().hex,
+                '123467',
+                'DFW',
+                'dns'
+            )
+
+        self.assertEqual(first, second, 'Cached plan was not used')
+        self.assertEqual(
+            first['dns']['limits'],
+            test_product.dns_full_return['dns']['limits'],
+            'Limits extracted from the plan did not match'
+        )
+
+    def test_api_request_retries_rate_limit(self):
+        limited = mock.Mock(
+            status_code=429,
+            ok=False,
+            headers={'Retry-After': '0'}
+        )
+        success = mock.Mock(status_code=200, content=json.dumps({'ok': 1}))
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.side_effect = [limited, success]
+            content = self.tasks.process_api_request(
+                'https://test.com/limits',
+                'get',
+                None,
+                self.tasks.generate_headers('token')
+            )
+
+        self.assertEqual(content, {'ok': 1}, 'Rate limited call not retried')
+        self.assertEqual(patched_get.call_count, 2)
+        assert patched_get.call_args[1].get('timeout'), 'No timeout was set'
+
+    def test_api_request_timeout_classified(self):
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.side_effect = (
+                self.tasks.requests.exceptions.ReadTimeout('timed out')
+            )
+            with mock.patch('time.sleep') as sleep:
+                content = self.tasks.process_api_request(
+                    'https://test.com/limits',
+                    'get',
+                    None,
+                    self.tasks.generate_headers('token')
+                )
+
+        assert not content, 'Failure was not false'
+        self.assertEqual(content.kind, 'timeout')
+        self.assertEqual(
+            patched_get.call_count,
+            self.tasks.config.UPSTREAM_RETRIES + 1,
+            'Timed out call was not retried'
+        )
+        self.assertEqual(sleep.call_count, self.tasks.config.UPSTREAM_RETRIES)
+
+    def test_failure_logs_hide_token(self):
+        url = 'https://identity.api.rackspacecloud.com/v2.0/tokens/secret'
+        self.assertEqual(
+            self.tasks.client.loggable_url(url + '?belongsTo=123467'),
+            'https://identity.api.rackspacecloud.com/v2.0/tokens/<redacted>',
+            'Token or query string was not removed from the URL'
+        )
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.side_effect = (
+                self.tasks.requests.exceptions.ConnectionError(url)
+            )
+            with mock.patch.object(self.tasks, 'logger') as logger:
+                content = self.tasks.send_once(
+                    self.tasks.client.get_session(url),
+                    url,
+                    'get',
+                    None,
+                    {}
+                )
+
+        assert 'secret' not in content.message, 'Token was in the message'
+        assert 'secret' not in repr(content), 'Token was in the failure'
+        assert 'secret' not in logger.error.call_args[0][0], (
+            'Token was logged'
+        )
+
+    def test_deadline_trims_timeouts(self):
+        self.tasks.client.set_deadline(time.time() + 2)
+        try:
+            connect, read = self.tasks.client.timeouts()
+            in_pool = self.tasks.client.submit(
+                self.tasks.client.current_deadline
+            ).get()
+            self.assertEqual(
+                in_pool,
+                self.tasks.client.current_deadline(),
+                'Deadline did not follow the call into the pool'
+            )
+        finally:
+            self.tasks.client.set_deadline(None)
+
+        assert read <= 2, 'Read timeout was not trimmed to the deadline'
+        self.assertEqual(self.tasks.client.timeouts(), (5.0, 30.0))
+
+    def test_expired_deadline_returns_partial_results(self):
+        self.db.products.insert(test_product.cbs)
+        self.db.limit_maps.insert(test_product.cbs_limit)
+        log_id = self.setup_usable_log('cbs')
+        with mock.patch('requests.Session.get') as patched_get:
+            results = self.tasks.cbs(
+                uuid.uuid4().hex,
+                '123467',
+                'DFW',
+                'cbs',
+                str(log_id),
+                deadline=time.time() - 1
+            )
+
+        self.tasks.clear_deadline()
+        assert not patched_get.called, 'Call was made past the deadline'
+        assert results['cbs'].get('incomplete'), 'Results not incomplete'
+        self.assertEqual(
+            results['cbs']['failures'][0].get('kind'),
+            'deadline'
+        )
+        self.assertEqual(
+            self.db.result_cache.count(),
+            0,
+            'Partial results were cached'
+        )
+
+    def breaker_config(self, **settings):
+        defaults = {
+            'BREAKER_FAILURE_THRESHOLD': 5,
+            'BREAKER_RESET_TIMEOUT': 30,
+            'BREAKER_COLLECTION': None
+        }
+        defaults.update(settings)
+        return mock.patch.multiple(self.tasks.config, create=True, **defaults)
+
+    def test_breaker_opens_and_fails_fast(self):
+        unavailable = mock.Mock(status_code=503, ok=False, headers={})
+        with self.breaker_config(BREAKER_FAILURE_THRESHOLD=2):
+            with mock.patch('requests.Session.get') as patched_get:
+                patched_get.return_value = unavailable
+                with mock.patch('time.sleep'):
+                    first = self.tasks.process_api_request(
+                        'https://syd.test.com/limits',
+                        'get',
+                        None,
+                        {}
+                    )
+                    second = self.tasks.process_api_request(
+                        'https://syd.test.com/other',
+                        'get',
+                        None,
+                        {}
+                    )
+
+        self.assertEqual(first.kind, 'degraded', 'Breaker did not open')
+        self.assertEqual(second.kind, 'degraded', 'Breaker did not stay open')
+        self.assertEqual(
+            patched_get.call_count,
+            2,
+            'Calls were made to an open host'
+        )
+
+    def test_breaker_probe_closes_after_reset(self):
+        circuit = self.tasks.breaker.get_breaker('https://syd.test.com/a')
+        with self.breaker_config(
+            BREAKER_FAILURE_THRESHOLD=1,
+            BREAKER_RESET_TIMEOUT=0
+        ):
+            circuit.record(False)
+            self.assertEqual(circuit.state, 'open', 'Breaker did not open')
+            assert circuit.allow(), 'Probe was not let through'
+            assert not circuit.allow(), 'Second probe was let through'
+            circuit.record(True)
+
+        self.assertEqual(circuit.state, 'closed', 'Probe did not close')
+        assert circuit.allow(), 'Closed breaker refused a call'
+
+    def test_breaker_state_shared_across_workers(self):
+        url = 'https://syd.test.com/limits'
+        with self.breaker_config(
+            BREAKER_FAILURE_THRESHOLD=1,
+            BREAKER_COLLECTION='circuit_breakers'
+        ):
+            self.tasks.breaker.get_breaker(url).record(
+                False,
+                self.db.circuit_breakers
+            )
+            shared = self.db.circuit_breakers.find_one(
+                {'_id': 'https://syd.test.com'}
+            )
+            self.assertEqual(shared.get('state'), 'open', 'State not shared')
+
+            # A fresh worker picks the open state up before calling the host
+            self.tasks.breaker.clear()
+            with mock.patch('requests.Session.get') as patched_get:
+                failure = self.tasks.process_api_request(url, 'get', None, {})
+
+        assert not patched_get.called, 'Call made to a degraded host'
+        self.assertEqual(failure.kind, 'degraded', 'Failure not degraded')
+
+    def limiter_config(self, **settings):
+        defaults = {
+            'LIMITER_INITIAL': 4,
+            'LIMITER_MIN': 1,
+            'LIMITER_MAX': 32,
+            'LIMITER_DECREASE': 0.5,
+            'LIMITER_LATENCY_TARGET': 2,
+            'LIMITER_COLLECTION': None,
+            'LIMITER_SYNC_INTERVAL': 0
+        }
+        defaults.update(settings)
+        return mock.patch.multiple(self.tasks.config, create=True, **defaults)
+
+    def test_limiter_backs_off_and_grows(self):
+        limited = mock.Mock(status_code=429, ok=False)
+        success = mock.Mock(status_code=200, ok=True)
+        with self.limiter_config():
+            window = self.tasks.limiter.get_limiter('https://test.com/a', '1')
+            started = window.acquire()
+            burst = window.acquire()
+            window.release(started, limited)
+            self.assertEqual(window.limit, 2, 'Limit was not cut')
+            window.release(burst, limited)
+            self.assertEqual(window.limit, 2, 'One burst cut the limit twice')
+            window.release(window.acquire(), success)
+
+        self.assertEqual(window.limit, 2.5, 'Limit did not grow')
+        self.assertEqual(window.in_flight, 0, 'Slots were not released')
+
+    def test_limiter_waits_for_a_slot(self):
+        with self.limiter_config(LIMITER_INITIAL=1):
+            window = self.tasks.limiter.get_limiter('https://test.com/a', '1')
+            started = window.acquire()
+            self.assertIsNone(
+                window.acquire(0.01),
+                'A slot was handed out over the limit'
+            )
+            window.release(started, mock.Mock(status_code=200, ok=True))
+            assert window.acquire(0.01), 'Released slot was not reused'
+
+    def test_limiter_backoff_shared_across_workers(self):
+        limited = mock.Mock(status_code=413, ok=False)
+        with self.limiter_config(LIMITER_COLLECTION='rate_limits'):
+            first = self.tasks.limiter.AdaptiveLimiter('https://test.com|1')
+            second = self.tasks.limiter.AdaptiveLimiter('https://test.com|1')
+            second.sync(self.db.rate_limits)
+            first.release(
+                first.acquire(None, self.db.rate_limits),
+                limited,
+                self.db.rate_limits
+            )
+            second.sync(self.db.rate_limits)
+
+        self.assertEqual(
+            self.db.rate_limits.find_one({'_id': 'https://test.com|1'}).get(
+                'backoffs'
+            ),
+            1,
+            'Rate limit was not counted'
+        )
+        self.assertEqual(second.limit, 2, 'Other worker did not back off')
+
+    def test_limiter_wait_keeps_breaker_probe(self):
+        url = 'https://syd.test.com/limits'
+        circuit = self.tasks.breaker.get_breaker(url)
+        success = mock.Mock(status_code=200, content=json.dumps({'ok': 1}))
+        with self.limiter_config(LIMITER_INITIAL=1):
+            with self.breaker_config(
+                BREAKER_FAILURE_THRESHOLD=1,
+                BREAKER_RESET_TIMEOUT=0
+            ):
+                circuit.record(False)
+                window = self.tasks.limiter.get_limiter(url)
+                held = window.acquire()
+                self.tasks.client.set_deadline(time.time() + 0.05)
+                try:
+                    with mock.patch('requests.Session.get') as patched_get:
+                        patched_get.return_value = success
+                        waited = self.tasks.process_api_request(
+                            url,
+                            'get',
+                            None,
+                            {}
+                        )
+                finally:
+                    self.tasks.clear_deadline()
+
+                window.release(held, success)
+                with mock.patch('requests.Session.get') as patched_get:
+                    patched_get.return_value = success
+                    content = self.tasks.process_api_request(
+                        url,
+                        'get',
+                        None,
+                        {}
+                    )
+
+        self.assertEqual(waited.kind, 'deadline')
+        self.assertEqual(content, {'ok': 1}, 'Probe was lost to the wait')
+        self.assertEqual(circuit.state, 'closed', 'Breaker did not close')
+
+    def test_mongo_errors_keep_local_state(self):
+        url = 'https://syd.test.com/limits'
+        limited = mock.Mock(status_code=429, ok=False)
+        broken = mock.Mock()
+        broken.find_one.side_effect = self.tasks.breaker.PyMongoError('down')
+        broken.update.side_effect = self.tasks.breaker.PyMongoError('down')
+        with self.limiter_config():
+            with self.breaker_config(BREAKER_FAILURE_THRESHOLD=1):
+                circuit = self.tasks.breaker.get_breaker(url)
+                assert circuit.allow(broken), 'Breaker refused a call'
+                circuit.record(False, broken)
+                window = self.tasks.limiter.get_limiter(url)
+                window.release(window.acquire(None, broken), limited, broken)
+
+        self.assertEqual(circuit.state, 'open', 'Breaker did not open')
+        self.assertEqual(window.limit, 2, 'Limit was not cut')
+        self.assertEqual(window.in_flight, 0, 'Slot was not released')
+
+    def test_api_request_releases_slot_on_error(self):
+        url = 'https://syd.test.com/limits'
+        with self.limiter_config():
+            with mock.patch.object(
+                self.tasks.breaker.CircuitBreaker,
+                'allow',
+                side_effect=RuntimeError('down')
+            ):
+                with self.assertRaises(RuntimeError):
+                    self.tasks.call_api(url, 'get', None, {})
+
+        window = self.tasks.limiter.get_limiter(url)
+        self.assertEqual(window.in_flight, 0, 'Slot was not released')
+
+    def test_api_request_limited_per_account(self):
+        limited = mock.Mock(
+            status_code=429,
+            ok=False,
+            headers={'Retry-After': '0'}
+        )
+        success = mock.Mock(status_code=200, content=json.dumps({'ok': 1}))
+        self.tasks.client.set_account('123467')
+        try:
+            with self.limiter_config():
+                with mock.patch('requests.Session.get') as patched_get:
+                    patched_get.side_effect = [limited, success]
+                    with mock.patch('time.sleep'):
+                        self.tasks.process_api_request(
+                            'https://test.com/limits',
+                            'get',
+                            None,
+                            {}
+                        )
+        finally:
+            self.tasks.clear_deadline()
+
+        window = self.tasks.limiter.get_limiter(
+            'https://test.com/limits',
+            '123467'
+        )
+        self.assertLess(window.limit, 4, 'Account limit did not back off')
+        other = self.tasks.limiter.get_limiter('https://test.com/limits', '1')
+        self.assertEqual(other.limit, 4, 'Other accounts were limited')
+
+    def hedge_config(self, **settings):
+        defaults = {
+            'HEDGE_REQUESTS': True,
+            'HEDGE_PERCENTILE': 95,
+            'HEDGE_SAMPLE_SIZE': 100,
+            'HEDGE_MIN_SAMPLES': 20,
+            'HEDGE_MAX_RATE': 1
+        }
+        defaults.update(settings)
+        return mock.patch.multiple(self.tasks.config, create=True, **defaults)
+
+    def test_latency_percentile_needs_samples(self):
+        with self.hedge_config():
+            window = self.tasks.hedging.get_window('https://test.com/a?b=1')
+            for sample in range(19):
+                window.add(sample / 100.0)
+
+            self.assertIsNone(window.percentile(95), 'Hedged too early')
+            window.add(0.19)
+            self.assertEqual(window.percentile(95), 0.18)
+            self.assertIs(
+                self.tasks.hedging.get_window('https://test.com/a?b=2'),
+                window,
+                'Pages of an endpoint did not share latencies'
+            )
+
+    def test_latency_window_shared_by_accounts(self):
+        windows = []
+        for account in ['123456', '654321']:
+            self.tasks.client.set_account(account)
+            windows.append(
+                self.tasks.hedging.get_window(
+                    'https://syd.test.com/v2/%s/limits' % account
+                )
+            )
+
+        self.tasks.clear_deadline()
+        self.assertIs(windows[0], windows[1], 'Window was kept per account')
+        self.assertEqual(
+            self.tasks.hedging.endpoint(
+                'https://syd.test.com/v2/123456/limits?page=2',
+                '123456'
+            ),
+            'https://syd.test.com/v2/{ddi}/limits'
+        )
+
+    def test_latency_windows_evicted(self):
+        with self.hedge_config(HEDGE_MAX_ENDPOINTS=2):
+            first = self.tasks.hedging.get_window('https://test.com/a')
+            self.tasks.hedging.get_window('https://test.com/b')
+            self.tasks.hedging.get_window('https://test.com/c')
+            again = self.tasks.hedging.get_window('https://test.com/a')
+
+        self.assertIsNot(first, again, 'Oldest endpoint was not evicted')
+
+    def test_hedge_budget_caps_rate(self):
+        budget = self.tasks.hedging.HedgeBudget()
+        for call in range(100):
+            budget.record_call()
+
+        taken = [budget.take(0.05) for attempt in range(10)]
+        self.assertEqual(taken.count(True), 5, 'Hedge rate was not capped')
+
+    def setup_slow_endpoint(self, url):
+        for sample in range(20):
+            self.tasks.hedging.record_latency(url, 0.01)
+
+        released = threading.Event()
+        slow = mock.Mock(status_code=200, content=json.dumps({'slow': 1}))
+        fast = mock.Mock(status_code=200, content=json.dumps({'fast': 1}))
+
+        def respond(*args, **kwargs):
+            if not respond.called_once:
+                respond.called_once = True
+                released.wait(5)
+                return slow
+
+            return fast
+
+        respond.called_once = False
+        return respond, released
+
+    def test_api_request_hedged(self):
+        url = 'https://test.com/limits'
+        with self.hedge_config():
+            respond, released = self.setup_slow_endpoint(url)
+            with mock.patch('requests.Session.get') as patched_get:
+                patched_get.side_effect = respond
+                try:
+                    content = self.tasks.process_api_request(
+                        url,
+                        'get',
+                        None,
+                        {}
+                    )
+                finally:
+                    released.set()
+
+        self.assertEqual(content, {'fast': 1}, 'Hedge did not win')
+        self.assertEqual(patched_get.call_count, 2, 'Hedge was not sent')
+
+    def test_api_request_hedge_over_budget(self):
+        url = 'https://test.com/limits'
+        with self.hedge_config(HEDGE_MAX_RATE=0):
+            respond, released = self.setup_slow_endpoint(url)
+            with mock.patch('requests.Session.get') as patched_get:
+                patched_get.side_effect = respond
+                threading.Timer(0.2, released.set).start()
+                content = self.tasks.process_api_request(
+                    url,
+                    'get',
+                    None,
+                    {}
+                )
+
+        self.assertEqual(content, {'slow': 1}, 'Call was hedged')
+        self.assertEqual(patched_get.call_count, 1, 'Hedge over budget')
+
+    def test_gather_limits_records_failure(self):
+        self.db.products.insert(test_product.dns)
+        self.db.limit_maps.insert(test_product.dns_limit)
+        unavailable = mock.Mock(status_code=503, ok=False, headers={})
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value = unavailable
+            with mock.patch('time.sleep'):
+                limits = self.tasks.gather_limits(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    'dns'
+                )
+
+        self.assertEqual(
+            limits['dns']['failures'],
+            [
+                {
+                    'kind': 'unavailable',
+                    'status': 503,
+                    'url': 'https://us.test.com/limits'
+                }
+            ],
+            'Failure was not classified in the results'
+        )
+        self.assertEqual(limits['dns']['values'], {})
+
+    def test_dns_task_records_domain_count_failure(self):
+        self.db.products.insert(test_product.dns)
+        self.db.limit_maps.insert(test_product.dns_limit)
+        limits = mock.Mock(
+            status_code=200,
+            content=json.dumps(test_product.dns_limit_return)
+        )
+        unavailable = mock.Mock(status_code=503, ok=False, headers={})
+
+        def respond(url, **kwargs):
+            if 'domains' in url:
+                return unavailable
+
+            return limits
+
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.side_effect = respond
+            with mock.patch('time.sleep'):
+                results = self.tasks.dns(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    'dns',
+                    str(self.setup_usable_log('dns'))
+                )
+
+        failures = results['dns'].get('failures')
+        self.assertEqual(len(failures), 1, 'Count failure was not recorded')
+        self.assertEqual(failures[0].get('kind'), 'unavailable')
+        assert 'domains' in failures[0].get('url'), 'Wrong failed call'
+
+    def test_load_balancer_listing_failure_collected(self):
+        failures = []
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value = mock.Mock(
+                status_code=429,
+                ok=False,
+                headers={'Retry-After': '0'}
+            )
+            with mock.patch('time.sleep'):
+                total = self.tasks.gather_all_load_balancers(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    failures
+                )
+
+        self.assertEqual(total, 0)
+        self.assertEqual(
+            [failure.kind for failure in failures],
+            ['rate_limited'],
+            'Listing failure was not collected'
+        )
+
+    def test_limit_plan_invalidated(self):
+        self.db.products.insert(test_product.dns)
+        self.db.limit_maps.insert(test_product.dns_limit)
+        plan = self.tasks.plans.get_plan(self.db, 'dns')
+        self.tasks.plans.invalidate(self.db)
+        self.assertIsNot(
+            plan,
+            self.tasks.plans.get_plan(self.db, 'dns'),
+            'Plan was not rebuilt after invalidation'
+        )
+
+    def test_limit_plan_list_index(self):
+        plan = self.tasks.plans.LimitPlan(
+            test_product.clb,
+            test_product.clb_limit
+        )
+        with mock.patch('cap.plans.index_by_name') as index:
+            index.return_value = {'LOADBALANCER_LIMIT': 25, 'NODE_LIMIT': 25}
+            limits = plan.extract(
+                plan.requests[0],
+                test_product.clb_limit_return,
+                {}
+            )
+
+        self.assertEqual(
+            index.call_count,
+            1,
+            'List response was indexed more than once'
+        )
+        self.assertEqual(
+            limits['load_balancers']['limits'],
+            test_product.clb_full_return['load_balancers']['limits'],
+            'Limits read from the index did not match'
+        )
+
+    def test_start_query_shares_limit_responses(self):
+        shared_url = 'https://us.test.com/v1.0/123467/limits'
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value.content = json.dumps(
+                test_product.dns_limit_return
+            )
+            patched_get.return_value.status_code = 200
+            with mock.patch('cap.tasks.check_authorized') as auth:
+                auth.return_value = True
+                with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                    with mock.patch.object(
+                        self.tasks.autoscale,
+                        'apply_async'
+                    ) as autoscale:
+                        self.tasks.start_query(
+                            uuid.uuid4().hex,
+                            '123467',
+                            'DFW',
+                            str(self.setup_usable_log('dns')),
+                            [['dns', 'dns-task'], ['autoscale', 'as-task']],
+                            [shared_url]
+                        )
+
+        self.assertEqual(
+            patched_get.call_count,
+            1,
+            'Shared limits URL was fetched more than once'
+        )
+        for task, task_id in [(dns, 'dns-task'), (autoscale, 'as-task')]:
+            kwargs = task.call_args[1]
+            self.assertEqual(kwargs.get('task_id'), task_id)
+            self.assertEqual(
+                task.call_args[0][1],
+                {
+                    'limit_responses': {
+                        shared_url: test_product.dns_limit_return
+                    },
+                    'deadline': None
+                },
+                'Shared response was not handed to the product task'
+            )
+
+    def test_dispatch_unknown_product_fails_task(self):
+        with mock.patch.object(
+            self.tasks.celery_app.backend,
+            'mark_as_failure'
+        ) as failed:
+            self.tasks.dispatch_products(
+                uuid.uuid4().hex,
+                '123467',
+                'DFW',
+                str(self.setup_usable_log('dns')),
+                [['bogus', 'bogus-task']],
+                []
+            )
+
+        self.assertEqual(
+            failed.call_args[0][0],
+            'bogus-task',
+            'Task for an unknown product was left pending'
+        )
+
+    def test_start_query_skips_shared_urls_answered_by_cache(self):
+        self.db.products.insert(test_product.dns)
+        self.db.limit_maps.insert(test_product.dns_limit)
+        self.tasks.cache_results(
+            '123467',
+            'DFW',
+            'autoscale',
+            {'autoscale': {'limits': {}, 'values': {}}}
+        )
+        with mock.patch('requests.Session.get') as patched_get:
+            with mock.patch('cap.tasks.check_authorized') as auth:
+                auth.return_value = True
+                with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                    self.tasks.start_query(
+                        uuid.uuid4().hex,
+                        '123467',
+                        'DFW',
+                        str(self.setup_usable_log('dns')),
+                        [['dns', 'dns-task'], ['autoscale', 'as-task']],
+                        ['https://us.test.com/limits']
+                    )
+
+        assert not patched_get.called, 'URL only one product needs was shared'
+        self.assertEqual(
+            dns.call_args[0][1].get('limit_responses'),
+            {},
+            'Shared response was handed to the product task'
+        )
+
+    def test_results_with_failures_not_cached(self):
+        results = {
+            'dns': {
+                'limits': {},
+                'values': {},
+                'failures': [
+                    {'kind': 'rate_limited', 'status': 429, 'url': 'x'}
+                ]
+            }
+        }
+        self.tasks.record_results(results, '123467', 'DFW', 'dns', None)
+        self.assertEqual(
+            self.db.result_cache.count(),
+            0,
+            'Results with failed calls were cached'
+        )
+
+    def test_start_query_fresh_cached_results(self):
+        log_id = str(self.setup_usable_log('dns'))
+        self.tasks.cache_results(
+            '123467',
+            'DFW',
+            'dns',
+            copy.deepcopy(test_product.dns_full_return)
+        )
+        with mock.patch('cap.tasks.check_authorized') as auth:
+            auth.return_value = True
+            with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                self.tasks.start_query(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    log_id,
+                    [['dns', 'dns-task']],
+                    []
+                )
+
+        assert not dns.called, 'Fresh result was fetched again'
+        task = self.tasks.check_tasks('dns-task')
+        self.assertEqual(task.state, 'SUCCESS')
+        self.assertEqual(
+            task.info['dns']['limits'],
+            test_product.dns_full_return['dns']['limits'],
+            'Cached limits were not returned'
+        )
+        assert task.info['dns'].get('cached_at'), 'Result age was not set'
+        assert not task.info['dns'].get('refreshing')
+
+    def test_start_query_stale_cached_results(self):
+        self.tasks.cache_results(
+            '123467',
+            'DFW',
+            'dns',
+            copy.deepcopy(test_product.dns_full_return)
+        )
+        self.db.result_cache.update(
+            {},
+            {'$inc': {'cached_at': -3600}}
+        )
+        with mock.patch('cap.tasks.check_authorized') as auth:
+            auth.return_value = True
+            with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                for task_id in ['first-task', 'second-task']:
+                    self.tasks.start_query(
+                        uuid.uuid4().hex,
+                        '123467',
+                        'DFW',
+                        str(self.setup_usable_log('dns')),
+                        [['dns', task_id]],
+                        []
+                    )
+
+        self.assertEqual(
+            dns.call_count,
+            1,
+            'Stale result was not refreshed exactly once'
+        )
+        args, kwargs = dns.call_args
+        self.assertIsNone(args[0][4], 'Refresh wrote to the query log')
+        self.assertNotIn(kwargs.get('task_id'), ['first-task', 'second-task'])
+        for task_id in ['first-task', 'second-task']:
+            task = self.tasks.check_tasks(task_id)
+            self.assertEqual(task.state, 'SUCCESS')
+            assert task.info['dns'].get('refreshing'), 'Stale not flagged'
+
+    def test_start_all_regions_query(self):
+        log_id = str(self.setup_usable_log('dns'))
+        with mock.patch('cap.tasks.check_authorized') as auth:
+            auth.return_value = True
+            with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                self.tasks.start_all_regions_query(
+                    uuid.uuid4().hex,
+                    '123467',
+                    log_id,
+                    [
+                        ['dfw', [['dns', 'dfw-task']], []],
+                        ['iad', [['dns', 'iad-task']], []]
+                    ]
+                )
+
+        self.assertEqual(auth.call_count, 1, 'Token was checked per region')
+        dispatched = sorted(
+            (call[0][0][2], call[1].get('task_id'))
+            for call in dns.call_args_list
+        )
+        self.assertEqual(
+            dispatched,
+            [('dfw', 'dfw-task'), ('iad', 'iad-task')],
+            'Product was not started in every region'
+        )
+        for call in dns.call_args_list:
+            self.assertEqual(
+                call[0][1].get('log_region'),
+                call[0][0][2],
+                'Logged results were not tagged with their region'
+            )
+
+    def test_region_tagged_in_query_log(self):
+        log_id = str(self.setup_usable_log('dns'))
+        self.tasks.record_results(
+            {'dns': {'limits': {}, 'values': {}}},
+            '123467',
+            'syd',
+            'dns',
+            log_id,
+            'syd'
+        )
+        log = self.db.query_logs.find_one()
+        self.assertEqual(
+            log.get('query_results')[0].get('region'),
+            'syd',
+            'Region was not kept with the logged results'
+        )
+
+    def test_start_query_identity_degraded(self):
+        log_id = str(self.setup_usable_log('dns'))
+        with mock.patch('cap.tasks.check_authorized') as auth:
+            auth.return_value = self.tasks.client.RequestFailure(
+                'degraded',
+                'https://identity.api.rackspacecloud.com/v2.0/tokens/x'
+            )
+            with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                started = self.tasks.start_query(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    log_id,
+                    [['dns', 'dns-task']],
+                    []
+                )
+
+        assert started is False, 'Query was started without a token check'
+        assert not dns.called, 'Product task was started'
+        task = self.tasks.check_tasks('dns-task')
+        self.assertEqual(task.state, 'FAILURE', 'Task was not failed')
+        assert 'degraded' in str(task.info), 'Failure was not reported'
+        log = self.db.query_logs.find_one()
+        assert not log.get('auth_failed'), 'Outage was reported as bad auth'
+
+    def test_check_authorized_only_rejects_auth_statuses(self):
+        with mock.patch('requests.Session.get') as patched_get:
+            patched_get.return_value = mock.Mock(status_code=401, ok=False)
+            rejected = self.tasks.check_authorized('123456', uuid4().hex)
+            patched_get.return_value = mock.Mock(
+                status_code=500,
+                ok=False,
+                headers={}
+            )
+            with mock.patch('time.sleep'):
+                failed = self.tasks.check_authorized('123456', uuid4().hex)
+
+        assert rejected is False, 'Bad token was not rejected'
+        self.assertEqual(failed.kind, 'server_error')
+
+    def test_start_query_bad_auth(self):
+        log_id = str(self.setup_usable_log('dns'))
+        with mock.patch('cap.tasks.check_authorized') as auth:
+            auth.return_value = False
+            with mock.patch.object(self.tasks.dns, 'apply_async') as dns:
+                started = self.tasks.start_query(
+                    uuid.uuid4().hex,
+                    '123467',
+                    'DFW',
+                    log_id,
+                    [['dns', 'dns-task']],
+                    []
+                )
+
+        assert started is False, 'Query was started with a bad token'
+        assert not dns.called, 'Product task was started'
+        self.assertEqual(
+            self.tasks.check_tasks('dns-task').state,
+            'REVOKED',
+            'Product task was not cancelled'
+        )
+        log = self.db.query_logs.find_one()
+        assert log.get('auth_failed'), 'Log was not marked as failed auth'
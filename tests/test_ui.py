@@ -16,6 +16,7 @@
 from fixtures import test_product
 from cap import setup_application
 from cap.config import config
+from cap import plans
 from uuid import uuid4
 
 
@@ -28,6 +29,7 @@ except:
 
 import unittest
 import json
+import time
 import mock
 import uuid
 import re
@@ -56,6 +58,7 @@ class UITests(unittest.TestCase):
         self.cap, self.db = setup_application.create_app(test_db)
         self.app = self.cap.test_client()
         self.app.get('/')
+        plans.clear()
 
     def tearDown(self):
         collections = [
@@ -286,7 +289,6 @@ class UITests(unittest.TestCase):
     """ Query Posts """
 
     def test_query_post_success(self):
-        task_id = uuid.uuid4().hex
         with self.app as c:
             with c.session_transaction() as sess:
                 self.setup_user_login(sess)
@@ -305,15 +307,12 @@ class UITests(unittest.TestCase):
                 True,
                 create=True
             ):
-                with mock.patch('cap.tasks.check_auth_token') as auth:
-                    auth.return_value = True
-                    with mock.patch('cap.tasks.dns') as limit:
-                        limit.return_value = task_id
-                        response = c.post(
-                            '/query/',
-                            data=json.dumps(data),
-                            content_type='application/json'
-                        )
+                with mock.patch('cap.tasks.start_query') as start:
+                    response = c.post(
+                        '/query/',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
 
         try:
             result = json.loads(response.data.decode('utf-8'))
@@ -331,8 +330,19 @@ class UITests(unittest.TestCase):
             'Incorrect length on tasks list'
         )
         assert tasks[0].get('dns'), 'Could not find test product in return'
+        assert result.get('query'), 'Could not find query handle in return'
+        self.assertEquals(
+            start.delay.call_args[0][4],
+            [('dns', tasks[0].get('dns'))],
+            'Product task was not handed to the query pipeline'
+        )
         log_entry = self.db.query_logs.find_one()
         assert log_entry, 'Log entry not found'
+        self.assertEquals(
+            log_entry.pop('tasks'),
+            {'dns': tasks[0].get('dns')},
+            'Task handles were not stored with the log'
+        )
         del log_entry['_id']
         del log_entry['queried_at']
         self.assertEquals(
@@ -341,7 +351,19 @@ class UITests(unittest.TestCase):
             'Log does not match expected value'
         )
 
-    def test_query_post_bad_auth(self):
+    def test_query_post_shared_limits(self):
+        plans.clear()
+        for db_name in ['cbs', 'big_data']:
+            product = dict(test_product.sample_product, db_name=db_name)
+            self.db.products.insert(product)
+            self.db.limit_maps.insert(
+                dict(
+                    test_product.sample_limit,
+                    product=db_name,
+                    uri='/{ddi}/limits'
+                )
+            )
+
         with self.app as c:
             with c.session_transaction() as sess:
                 self.setup_user_login(sess)
@@ -353,29 +375,129 @@ class UITests(unittest.TestCase):
                 'ddi': '123456',
                 'region': 'dfw',
                 'token': uuid.uuid4().hex,
-                'servers': 'y'
+                'cbs': 'y',
+                'big_data': 'y'
             }
-            with mock.patch('cap.tasks.check_auth_token') as auth:
-                auth.return_value = False
-                result = c.post(
+            with mock.patch('cap.tasks.start_query') as start:
+                response = c.post(
                     '/query/',
                     data=json.dumps(data),
                     content_type='application/json'
                 )
 
-        returned = json.loads(result.data.decode('utf-8'))
-        log_entry = self.db.query_logs.find_one()
+        result = json.loads(response.data.decode('utf-8'))
         self.assertEquals(
-            returned,
-            test_product.sample_auth_failure,
-            'Invalid response received from successfull query submit'
+            2,
+            len(result.get('tasks')),
+            'Incorrect length on tasks list'
+        )
+        self.assertEquals(
+            start.delay.call_args[0][5],
+            ['http://us.test.com/123456/limits'],
+            'Shared limits URL was not handed to the query task'
         )
+
+    def test_query_post_unknown_product(self):
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            response = c.get('/query/')
+            token = self.retrieve_csrf_token(response.data)
+            data = {
+                'csrf_token': token,
+                'ddi': '123456',
+                'region': 'dfw',
+                'token': uuid.uuid4().hex,
+                'dns': 'y',
+                'bogus': 'y'
+            }
+            with mock.patch('cap.tasks.start_query') as start:
+                response = c.post(
+                    '/query/',
+                    data=json.dumps(data),
+                    content_type='application/json'
+                )
+
+        self.assertEquals(response.status_code, 400)
+        self.assertIn(
+            'bogus',
+            json.loads(response.data.decode('utf-8')).get('message')
+        )
+        assert not start.delay.called, 'Query was started for a bad product'
+        self.assertEquals(self.db.query_logs.count(), 0)
+
+    def test_query_post_invalid_account(self):
+        bad_queries = [
+            ({'region': 'dfw', 'token': uuid.uuid4().hex}, 'missing a DDI'),
+            (
+                {'ddi': None, 'region': 'dfw', 'token': uuid.uuid4().hex},
+                'missing a DDI'
+            ),
+            (
+                {'ddi': ['123456'], 'region': 'dfw', 'token': 'x'},
+                'invalid DDI'
+            ),
+            ({'ddi': '123456', 'region': 'dfw'}, 'token is required'),
+            (
+                {'ddi': '123456', 'region': 'nowhere', 'token': 'x'},
+                'unknown region: nowhere'
+            )
+        ]
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            response = c.get('/query/')
+            csrf_token = self.retrieve_csrf_token(response.data)
+            with mock.patch('cap.tasks.start_query') as start:
+                for data, message in bad_queries:
+                    data = dict(data, csrf_token=csrf_token, dns='y')
+                    response = c.post(
+                        '/query/',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+                    self.assertEquals(response.status_code, 400)
+                    self.assertIn(
+                        message,
+                        json.loads(response.data.decode('utf-8')).get(
+                            'message'
+                        )
+                    )
+
+        assert not start.delay.called, 'Query was started for a bad query'
+        self.assertEquals(self.db.query_logs.count(), 0)
+
+    def test_query_post_defers_auth(self):
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            response = c.get('/query/')
+            token = self.retrieve_csrf_token(response.data)
+            data = {
+                'csrf_token': token,
+                'ddi': '123456',
+                'region': 'dfw',
+                'token': uuid.uuid4().hex,
+                'servers': 'y'
+            }
+            with mock.patch('cap.tasks.check_auth_token') as auth:
+                with mock.patch('cap.tasks.start_query') as start:
+                    result = c.post(
+                        '/query/',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+
         self.assertEquals(
             result.status_code,
-            401,
-            'Invalid status code received on bad auth'
+            202,
+            'Invalid status code received on query submit'
         )
-        assert log_entry is None, 'Log entry found when should not have been'
+        assert not auth.called, 'Token was verified inside the web request'
+        assert start.delay.called, 'Query pipeline was not started'
 
     """ Task Status and returns w/ template functions """
 
@@ -417,6 +539,468 @@ class UITests(unittest.TestCase):
             'Failed check did not return the correct data object'
         )
 
+    def test_task_status_revoked(self):
+        state = SetState('REVOKED', 'Authentication failed')
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                response = c.get(
+                    '/query/status/%s' % uuid4().hex
+                )
+
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(
+            results,
+            {
+                'state': 'REVOKED',
+                'status': test_product.sample_auth_failure.get('message')
+            },
+            'Revoked check did not return the auth failure message'
+        )
+
+    def test_task_status_not_modified(self):
+        state = SetState('PENDING', None)
+        task_id = uuid4().hex
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                with mock.patch('cap.tasks.queue_depth') as depth:
+                    depth.return_value = 8
+                    first = c.get('/query/status/%s' % task_id)
+                    response = c.get(
+                        '/query/status/%s' % task_id,
+                        headers={'If-None-Match': first.headers.get('ETag')}
+                    )
+
+        self.assertEquals(
+            response.status_code,
+            304,
+            'Unchanged status was returned in full'
+        )
+        self.assertEquals(
+            response.headers.get('X-Poll-Interval'),
+            '3000',
+            'Poll interval did not account for the queue depth'
+        )
+
+    def test_task_status_poll_interval_finished(self):
+        state = SetState('FAILURE', 'Test Error Message')
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                with mock.patch('cap.tasks.queue_depth') as depth:
+                    response = c.get(
+                        '/query/status/%s' % uuid4().hex
+                    )
+
+        assert response.headers.get('ETag'), 'No ETag was set on the status'
+        self.assertEquals(response.headers.get('X-Poll-Interval'), '1000')
+        assert not depth.called, 'Queue depth was read for a finished task'
+
+    def test_query_status_batched(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        query_id = self.db.query_logs.insert(
+            dict(
+                test_product.sample_log,
+                tasks={'test': 'test-task', 'dns': 'dns-task', 'cbs': 'cbs'}
+            )
+        )
+        states = {
+            'test-task': SetState(
+                'SUCCESS',
+                {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+            ),
+            'dns-task': SetState('PENDING', None)
+        }
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.side_effect = states.get
+                response = c.get(
+                    '/query/results/%s?seen=cbs' % query_id
+                )
+
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(
+            results.get('state'),
+            'PENDING',
+            'Query should be pending while a task is unfinished'
+        )
+        self.assertEquals(
+            sorted(results.get('tasks')),
+            ['dns', 'test'],
+            'Seen products should not be looked up again'
+        )
+        self.assertEquals(check_task.call_count, 2)
+        self.assertIn(
+            'text-success',
+            results['tasks']['test'].get('result'),
+            'Finished product fragment was not rendered'
+        )
+
+    def test_query_status_catalog_cached(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        query_id = self.db.query_logs.insert(
+            dict(
+                test_product.sample_log,
+                tasks={'test': 'test-task', 'other': 'other-task'}
+            )
+        )
+        state = SetState(
+            'SUCCESS',
+            {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+        )
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                with mock.patch(
+                    'cap.plans.load_catalog',
+                    wraps=plans.load_catalog
+                ) as load:
+                    c.get('/query/results/%s' % query_id)
+                    c.get('/query/results/%s' % query_id)
+
+        self.assertEquals(
+            load.call_count,
+            1,
+            'Products were not loaded from the process catalog'
+        )
+
+    def test_query_status_auth_failed(self):
+        query_id = self.db.query_logs.insert(
+            dict(
+                test_product.sample_log,
+                tasks={'dns': 'dns-task'},
+                auth_failed=True
+            )
+        )
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            response = c.get('/query/results/%s' % query_id)
+
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(
+            results,
+            {
+                'state': 'REVOKED',
+                'status': test_product.sample_auth_failure.get('message')
+            },
+            'Auth failure was not reported for the query'
+        )
+
+    def test_query_stream_results(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        query_id = self.db.query_logs.insert(
+            dict(test_product.sample_log, tasks={'test': 'test-task'})
+        )
+        state = SetState(
+            'SUCCESS',
+            {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+        )
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                response = c.get('/query/stream/%s' % query_id)
+                data = response.data.decode('utf-8')
+
+        self.assertEquals(
+            response.mimetype,
+            'text/event-stream',
+            'Results were not returned as an event stream'
+        )
+        events = [
+            event for event in data.split('\n\n') if event.strip()
+        ]
+        self.assertEquals(len(events), 2, 'Incorrect number of events')
+        self.assertIn('event: result', events[0])
+        self.assertIn('text-success', events[0])
+        self.assertEquals(
+            events[1],
+            'event: complete\ndata: {"pending": []}',
+            'Stream was not completed after every result was sent'
+        )
+
+    def test_query_post_all_regions(self):
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            data = {
+                'ddi': '123456',
+                'region': 'all',
+                'token': uuid.uuid4().hex,
+                'dns': 'y'
+            }
+            with mock.patch('cap.tasks.start_all_regions_query') as start:
+                with mock.patch('cap.tasks.start_query') as single:
+                    response = c.post(
+                        '/query/',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+
+        result = json.loads(response.data.decode('utf-8'))
+        regions = ['dfw', 'ord', 'iad', 'syd', 'lon', 'hkg']
+        self.assertEquals(
+            sorted(list(task)[0] for task in result.get('tasks')),
+            sorted('dns:%s' % region for region in regions),
+            'A task was not started for every region'
+        )
+        assert not single.delay.called, 'Single region query was started'
+        self.assertEquals(start.delay.call_count, 1, 'Auth was not shared')
+        self.assertEquals(
+            [entry[0] for entry in start.delay.call_args[0][3]],
+            regions
+        )
+        log_entry = self.db.query_logs.find_one()
+        self.assertEquals(log_entry.get('regions'), regions)
+
+    def test_query_region_comparison(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        query_id = self.db.query_logs.insert(
+            dict(
+                test_product.sample_log,
+                tasks={'test:dfw': 'dfw-task', 'test:iad': 'iad-task'},
+                regions=['dfw', 'iad']
+            )
+        )
+        states = {
+            'dfw-task': SetState(
+                'SUCCESS',
+                {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+            ),
+            'iad-task': SetState('PENDING', None)
+        }
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.side_effect = states.get
+                with mock.patch('cap.tasks.queue_depth') as depth:
+                    depth.return_value = 0
+                    response = c.get('/query/compare/%s' % query_id)
+
+        results = json.loads(response.data.decode('utf-8'))
+        self.assertEquals(results.get('state'), 'PENDING')
+        comparison = results['products']['test']
+        self.assertIn('DFW', comparison, 'Region column was not rendered')
+        self.assertIn('1 / 20', comparison, 'Region result was not shown')
+        self.assertIn('fa-spin', comparison, 'Pending region was not shown')
+
+    def test_query_region_comparison_degraded(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        query_id = self.db.query_logs.insert(
+            dict(
+                test_product.sample_log,
+                tasks={'test:dfw': 'dfw-task', 'test:syd': 'syd-task'},
+                regions=['dfw', 'syd']
+            )
+        )
+        degraded = {
+            'kind': 'degraded',
+            'status': None,
+            'url': 'https://syd.test.com/limits'
+        }
+        states = {
+            'dfw-task': SetState(
+                'SUCCESS',
+                {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+            ),
+            'syd-task': SetState(
+                'SUCCESS',
+                {'test': {'limits': {}, 'failures': [degraded]}}
+            )
+        }
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.side_effect = states.get
+                with mock.patch('cap.tasks.queue_depth') as depth:
+                    depth.return_value = 0
+                    response = c.get('/query/compare/%s' % query_id)
+
+        comparison = json.loads(
+            response.data.decode('utf-8')
+        )['products']['test']
+        self.assertIn(
+            'Region degraded',
+            comparison,
+            'Degraded region was not shown'
+        )
+
+    def test_query_batch_streams_results(self):
+        self.db.products.insert(
+            dict(test_product.sample_product, db_name='cbs')
+        )
+        self.setup_usable_limit()
+        state = SetState(
+            'SUCCESS',
+            {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+        )
+        started_at_check = []
+        data = {
+            'token': uuid.uuid4().hex,
+            'accounts': [
+                {'ddi': '123456', 'region': 'dfw', 'products': ['cbs']},
+                {'ddi': '654321', 'region': 'iad', 'products': ['cbs']}
+            ]
+        }
+        self.cap.config['BATCH_CONCURRENCY'] = 1
+        self.cap.config['STREAM_POLL_INTERVAL'] = 0
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.start_query') as start:
+                with mock.patch('cap.tasks.check_tasks') as check_task:
+                    def check(task_id):
+                        started_at_check.append(start.delay.call_count)
+                        return state
+
+                    check_task.side_effect = check
+                    response = c.post(
+                        '/query/batch',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+                    lines = response.data.decode('utf-8').splitlines()
+
+        self.assertEquals(response.mimetype, 'application/x-ndjson')
+        results = [json.loads(line) for line in lines]
+        self.assertEquals(
+            [result.get('ddi') for result in results],
+            ['123456', '654321'],
+            'A line was not streamed for each account'
+        )
+        self.assertEquals(results[0].get('state'), 'SUCCESS')
+        self.assertEquals(
+            results[0].get('results'),
+            {'test': {'limits': {'Test': 20}, 'values': {'Test': 1}}}
+        )
+        self.assertEquals(
+            started_at_check,
+            [1, 2],
+            'More accounts were started than the concurrency allows'
+        )
+        self.assertEquals(self.db.query_logs.count(), 2)
+
+    def test_query_batch_unknown_product(self):
+        self.setup_usable_product()
+        data = {
+            'token': uuid.uuid4().hex,
+            'accounts': [
+                {'ddi': '123456', 'region': 'dfw', 'products': ['bad']}
+            ]
+        }
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.start_query') as start:
+                response = c.post(
+                    '/query/batch',
+                    data=json.dumps(data),
+                    content_type='application/json'
+                )
+
+        self.assertEquals(response.status_code, 400)
+        self.assertIn(
+            'unknown product: bad',
+            json.loads(response.data.decode('utf-8')).get('message')
+        )
+        assert not start.delay.called, 'Query was started for a bad batch'
+
+    def test_query_batch_invalid_accounts(self):
+        self.db.products.insert(
+            dict(test_product.sample_product, db_name='cbs')
+        )
+        bad_accounts = [
+            ({'ddi': ['123456'], 'region': 'dfw', 'products': ['cbs']},
+                'invalid DDI'),
+            ({'ddi': '123456', 'region': 'all', 'products': ['cbs']},
+                'unknown region: all'),
+            ({'ddi': '123456', 'region': 'dfw', 'products': [['cbs']]},
+                'invalid product')
+        ]
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.start_query') as start:
+                for account, message in bad_accounts:
+                    response = c.post(
+                        '/query/batch',
+                        data=json.dumps(
+                            {'token': uuid.uuid4().hex, 'accounts': [account]}
+                        ),
+                        content_type='application/json'
+                    )
+                    self.assertEquals(response.status_code, 400)
+                    self.assertIn(
+                        message,
+                        json.loads(response.data.decode('utf-8')).get(
+                            'message'
+                        )
+                    )
+
+        assert not start.delay.called, 'Query was started for a bad batch'
+
+    def test_query_batch_numeric_ddi(self):
+        self.db.products.insert(
+            dict(test_product.sample_product, db_name='cbs')
+        )
+        state = SetState('SUCCESS', {})
+        data = {
+            'token': uuid.uuid4().hex,
+            'accounts': [
+                {'ddi': 123456, 'region': 'dfw', 'products': ['cbs']}
+            ]
+        }
+        self.cap.config['STREAM_POLL_INTERVAL'] = 0
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.start_query') as start:
+                with mock.patch('cap.tasks.check_tasks') as check_task:
+                    check_task.return_value = state
+                    response = c.post(
+                        '/query/batch',
+                        data=json.dumps(data),
+                        content_type='application/json'
+                    )
+                    lines = response.data.decode('utf-8').splitlines()
+
+        self.assertEquals(len(lines), 1, 'Stream was cut short')
+        self.assertEquals(start.delay.call_args[0][1], '123456')
+
     def test_task_status_success_warning(self):
         self.setup_usable_product()
         self.setup_usable_limit()
@@ -491,6 +1075,70 @@ class UITests(unittest.TestCase):
             'Could not find text success classes'
         )
 
+    def test_task_status_success_cached(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        success_data = {
+            'test': {
+                'limits': {'Test': 20},
+                'values': {'Test': 1},
+                'cached_at': time.time() - 600,
+                'refreshing': True
+            }
+        }
+        state = SetState('SUCCESS', success_data)
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                response = c.get(
+                    '/query/status/%s' % uuid4().hex
+                )
+
+        self.assertIn(
+            'Cached 10 minutes ago, refreshing in the background',
+            response.data.decode('utf-8'),
+            'Age of the cached result was not shown'
+        )
+
+    def test_task_status_success_degraded(self):
+        self.setup_usable_product()
+        self.setup_usable_limit()
+        success_data = {
+            'test': {
+                'limits': {},
+                'failures': [{
+                    'kind': 'degraded',
+                    'status': None,
+                    'url': 'https://syd.test.com/limits'
+                }]
+            }
+        }
+        state = SetState('SUCCESS', success_data)
+        with self.app as c:
+            with c.session_transaction() as sess:
+                self.setup_user_login(sess)
+
+            with mock.patch('cap.tasks.check_tasks') as check_task:
+                check_task.return_value = state
+                response = c.get(
+                    '/query/status/%s' % uuid4().hex
+                )
+
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertIn(
+            'Region degraded',
+            data.get('result'),
+            'Degraded region was not shown'
+        )
+        self.assertEqual(
+            data.get('degraded'),
+            ['https://syd.test.com/limits'],
+            'Degraded call missing from the status'
+        )
+
     def test_task_status_success_no_product(self):
         self.setup_usable_product()
         self.setup_usable_limit()